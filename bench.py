@@ -0,0 +1,479 @@
+# Offline load test for betbrobot: drives the real handlers with fake Discord
+# objects against a throwaway PostgreSQL database and reports per-command
+# latency, pool wait and queries per command.
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/betbro_bench python bench.py --ops 2000 --concurrency 50
+#
+# The bench database is migrated and then TRUNCATEd, so never point it at production.
+#
+# --gateway-compare instead starts the real bot twice as a gateway process,
+# with LOW_MEMORY=0 and then LOW_MEMORY=1, and reports time to first READY and
+# RSS for each from /metrics. It needs DISCORD_TOKEN for a bot in a real guild
+# (compare on the same guild, ideally a large one):
+#
+#   DISCORD_TOKEN=... GUILD_ID=... python bench.py --dsn $BENCH_DATABASE_URL --gateway-compare
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+import asyncpg
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import betbrobot
+
+DEFAULT_MIX = "wager=2,confirmpayment=2,resolve=2,ipn=2,leaderboard=1,rank=2,profile=4"
+
+# Per-operation counters, visible to the pool and query-logger hooks below
+current_op = contextvars.ContextVar("current_op", default=None)
+
+# ---------- Fake Discord ----------
+class FakeAvatar:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+class FakeUser:
+    def __init__(self, uid: int, latency: float = 0):
+        self.id = uid
+        self.bot = False
+        self.name = self.display_name = f"user{uid}"
+        self.mention = f"<@{uid}>"
+        self.display_avatar = FakeAvatar()
+        self.latency = latency
+
+    async def send(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+
+    async def add_roles(self, *roles):
+        await asyncio.sleep(self.latency)
+
+    async def remove_roles(self, *roles):
+        await asyncio.sleep(self.latency)
+
+class FakeRole:
+    def __init__(self, name: str):
+        self.name = name
+
+class FakeChannel:
+    def __init__(self, cid: int, name: str = "general", latency: float = 0):
+        self.id = cid
+        self.name = name
+        self.latency = latency
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+        await asyncio.sleep(self.latency)
+
+class FakeGuild:
+    def __init__(self, latency: float):
+        self.id = betbrobot.GUILD_ID
+        self.latency = latency
+        self.roles = [FakeRole(n) for n in ["N/A", "low", "mid", "high"] + [f"R{i}" for i in range(1, 11)]]
+
+    def get_member(self, uid: int):
+        # A low-memory gateway has no member cache, so lookups fall through to
+        # betbrobot's LRU and then fetch_member, as they would in production.
+        return None if betbrobot.LOW_MEMORY else FakeUser(uid, self.latency)
+
+    async def fetch_member(self, uid: int):
+        await asyncio.sleep(self.latency)
+        return FakeUser(uid, self.latency)
+
+class FakeResponse:
+    def __init__(self, op: dict, latency: float):
+        self.op = op
+        self.latency = latency
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        if content and content.startswith("❌"):
+            self.op["failed"] = True
+        await asyncio.sleep(self.latency)
+
+    async def defer(self, **kwargs):
+        self._done = True
+        await asyncio.sleep(self.latency)
+
+class FakeFollowup:
+    def __init__(self, op: dict, latency: float):
+        self.op = op
+        self.latency = latency
+
+    async def send(self, content=None, **kwargs):
+        if content and content.startswith("❌"):
+            self.op["failed"] = True
+        await asyncio.sleep(self.latency)
+
+class FakeInteraction:
+    def __init__(self, user: FakeUser, guild: FakeGuild, op: dict, latency: float):
+        self.user = user
+        self.guild = guild
+        self.response = FakeResponse(op, latency)
+        self.followup = FakeFollowup(op, latency)
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, content: str, channel: FakeChannel, guild: FakeGuild, author: FakeUser):
+        self.id = next(self._ids)
+        self.content = content
+        self.channel = channel
+        self.guild = guild
+        self.author = author
+
+# ---------- Instrumentation ----------
+def attribute_pool_wait(hist):
+    # betbrobot.InstrumentedPool reports every acquire wait to DB_ACQUIRE_SECONDS;
+    # the observation happens in the acquiring task, so charge it to that op too.
+    observe = hist.observe
+
+    def observe_for_op(value: float, **labels):
+        op = current_op.get()
+        if op is not None:
+            op["pool_wait"] += value
+        observe(value, **labels)
+
+    hist.observe = observe_for_op
+
+def count_query(record):
+    # Query loggers run via call_soon, which carries the issuing task's context.
+    op = current_op.get()
+    if op is not None:
+        op["queries"] += 1
+
+async def init_connection(conn):
+    conn.add_query_logger(count_query)
+
+# ---------- Workload ----------
+class Workload:
+    def __init__(self, args, client: TestClient):
+        self.args = args
+        self.client = client
+        self.rng = random.Random(args.seed)
+        self.latency = args.discord_latency / 1000
+        self.guild = FakeGuild(self.latency)
+        self.rank_channel = FakeChannel(1, "rank-logs", self.latency)
+        self.users = list(range(1000, 1000 + args.users))
+        self.open_wagers = []      # funded, unsupervised: consumed by resolve
+        self.pending_wagers = []   # supervised, awaiting payments
+        self.txn = 0
+
+    def user(self, uid=None) -> FakeUser:
+        return FakeUser(uid or self.rng.choice(self.users), self.latency)
+
+    def interaction(self, op: dict, user=None) -> FakeInteraction:
+        return FakeInteraction(user or self.user(), self.guild, op, self.latency)
+
+    def two_players(self):
+        return self.rng.sample(self.users, 2)
+
+    async def seed(self, resolves: int):
+        pool = betbrobot.db_pool
+        await pool.execute(
+            "TRUNCATE wagers, payments, users, user_ranks, ipn_events, coin_ledger CASCADE"
+        )
+        await pool.executemany(
+            "INSERT INTO users(user_id,wins,losses,coins) VALUES($1,$2,$3,$4)",
+            [(u, self.rng.randint(0, 40), self.rng.randint(0, 40), self.rng.randint(0, 20000))
+             for u in self.users]
+        )
+        wagers, payments = [], []
+        for i in range(resolves + self.args.users):
+            p1, p2 = self.two_players()
+            wid = f"BENCH-{i:06d}"
+            supervised = i >= resolves
+            wagers.append((wid, p1, p1, p2, 10, supervised, "pending" if supervised else "paid"))
+            payments += [(wid, p1, not supervised), (wid, p2, not supervised)]
+            (self.pending_wagers if supervised else self.open_wagers).append((wid, p1, p2))
+        await pool.executemany(
+            "INSERT INTO wagers(wager_id,host_id,p1_id,p2_id,amount_usd,is_supervised,status) "
+            "VALUES($1,$2,$3,$4,$5,$6,$7)", wagers
+        )
+        await pool.executemany(
+            "INSERT INTO payments(wager_id,user_id,paid) VALUES($1,$2,$3)", payments
+        )
+        await betbrobot.load_rank_cache()
+        # Without the role index rank changes resolve no roles and skip the role edits
+        betbrobot.rebuild_role_index(self.guild)
+        betbrobot.member_cache.clear()
+        # Live path only; nothing to catch up on in the bench channel
+        betbrobot.rank_checkpoints[self.rank_channel.id] = 0
+        betbrobot.rank_replayed_gen[self.rank_channel.id] = betbrobot.rank_log_gen
+        betbrobot.role_board.invalidate()
+        betbrobot.stats_board.invalidate()
+        betbrobot.profile_cache.clear()
+
+    async def wager(self, op):
+        me, opponent = self.two_players()
+        await betbrobot.wager_cmd.callback(
+            self.interaction(op, self.user(me)), self.user(opponent), 10.0, "https://example.com/game"
+        )
+
+    async def confirmpayment(self, op):
+        wid, p1, p2 = self.rng.choice(self.pending_wagers)
+        await betbrobot.confirmpayment.callback(self.interaction(op), wid, self.user(self.rng.choice((p1, p2))))
+
+    async def resolve(self, op):
+        if not self.open_wagers:
+            return
+        wid, p1, p2 = self.open_wagers.pop()
+        await betbrobot.resolve.callback(self.interaction(op), wid, self.user(self.rng.choice((p1, p2))), "2-1")
+
+    async def ipn(self, op):
+        # Runs in the web server's task, so its DB time only shows up as latency.
+        wid, p1, p2 = self.rng.choice(self.pending_wagers)
+        self.txn += 1
+        body = urlencode({
+            "payment_status": "Completed", "txn_id": f"BENCH-TXN-{self.txn}",
+            "invoice": wid, "custom": self.rng.choice((p1, p2)),
+        })
+        resp = await self.client.post(
+            "/paypal/ipn", data=body, headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        if resp.status != 200:
+            op["failed"] = True
+
+    async def leaderboard(self, op):
+        await betbrobot.leaderboard.callback(self.interaction(op), self.rng.choice(("role", "stats")))
+
+    async def rank(self, op):
+        uid = self.rng.choice(self.users)
+        rank, tier = betbrobot.rank_cache.get(uid, ("N/A", "none"))
+        new_rank = f"R{self.rng.randint(1, 10)}"
+        new_tier = self.rng.choice(("low", "mid", "high"))
+        old = rank if tier == "none" else f"{rank} {tier}"
+        msg = FakeMessage(f"<@{uid}> {old} to {new_rank} {new_tier}",
+                          self.rank_channel, self.guild, self.user())
+        await betbrobot.on_message(msg)
+
+    async def profile(self, op):
+        await betbrobot.profile.callback(self.interaction(op), self.user())
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def run(args) -> dict:
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    plan = rng.choices(list(mix), weights=list(mix.values()), k=args.ops)
+
+    attribute_pool_wait(betbrobot.DB_ACQUIRE_SECONDS)
+    betbrobot.db_pool = betbrobot.InstrumentedPool(await asyncpg.create_pool(
+        args.dsn, min_size=args.pool_size, max_size=args.pool_size, init=init_connection
+    ))
+    betbrobot.http_session = aiohttp.ClientSession()
+    await betbrobot.migrate()
+    betbrobot.db_ready.set()
+
+    # Local stand-in for PayPal's postback verification
+    async def verify(request):
+        return web.Response(text="VERIFIED")
+    paypal = web.Application()
+    paypal.router.add_post("/cgi-bin/webscr", verify)
+    paypal_server = TestServer(paypal)
+    await paypal_server.start_server()
+    betbrobot.PAYPAL_VERIFY_URL = str(paypal_server.make_url("/cgi-bin/webscr"))
+
+    client = TestClient(TestServer(betbrobot.app))
+    await client.start_server()
+
+    workload = Workload(args, client)
+    await workload.seed(plan.count("resolve"))
+    latency = args.discord_latency / 1000
+    channels = {}
+    betbrobot.bot.get_channel = lambda cid: channels.setdefault(cid, FakeChannel(cid, latency=latency))
+    betbrobot.bot.get_user = lambda uid: FakeUser(uid, latency)
+
+    async def process_commands(message):
+        pass
+    betbrobot.bot.process_commands = process_commands
+
+    results = {name: [] for name in mix}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(name):
+        op = {"pool_wait": 0.0, "queries": 0, "failed": False}
+        async with sem:
+            current_op.set(op)
+            started = time.perf_counter()
+            try:
+                await getattr(workload, name)(op)
+            except Exception as e:
+                op["failed"] = True
+                op["error"] = repr(e)
+            op["latency"] = time.perf_counter() - started
+            await asyncio.sleep(0)  # let pending query-logger callbacks land
+        results[name].append(op)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(name) for name in plan))
+    elapsed = time.perf_counter() - started
+
+    drain_started = time.perf_counter()
+    drained = 0
+    while True:
+        n = await betbrobot.process_ipn_batch()
+        if not n:
+            break
+        drained += n
+    drain_elapsed = time.perf_counter() - drain_started
+
+    await client.close()
+    await paypal_server.close()
+    await betbrobot.http_session.close()
+    await betbrobot.db_pool.close()
+
+    report = {"ops": args.ops, "elapsed_s": elapsed, "ops_per_s": args.ops / elapsed,
+              "ipn_drained": drained, "ipn_drain_s": drain_elapsed, "commands": {}}
+    for name, ops in results.items():
+        if not ops:
+            continue
+        lat = [o["latency"] * 1000 for o in ops]
+        report["commands"][name] = {
+            "n": len(ops),
+            "p50_ms": pct(lat, 0.50),
+            "p99_ms": pct(lat, 0.99),
+            "pool_wait_ms": sum(o["pool_wait"] for o in ops) * 1000 / len(ops),
+            "queries": sum(o["queries"] for o in ops) / len(ops),
+            "errors": sum(o["failed"] for o in ops),
+        }
+    return report
+
+# ---------- Gateway comparison ----------
+def parse_metrics(text: str) -> dict:
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            values[name] = float(value)
+    return values
+
+async def gateway_run(session: aiohttp.ClientSession, low_memory: bool, args) -> dict:
+    env = {**os.environ, "BOT_ROLE": "gateway", "LOW_MEMORY": "1" if low_memory else "0",
+           "PORT": str(args.gateway_port), "DATABASE_URL": args.dsn}
+    # The bot's own output passes through, so login failures are visible
+    proc = await asyncio.create_subprocess_exec(sys.executable, betbrobot.__file__, env=env)
+    url = f"http://127.0.0.1:{args.gateway_port}/metrics"
+    try:
+        deadline = time.monotonic() + args.gateway_timeout
+        metrics = {}
+        while "betbro_ready_seconds" not in metrics:
+            if proc.returncode is not None:
+                raise RuntimeError(f"bot exited with {proc.returncode} before READY")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"no READY within {args.gateway_timeout:.0f}s")
+            await asyncio.sleep(0.5)
+            try:
+                async with session.get(url) as resp:
+                    metrics = parse_metrics(await resp.text())
+            except aiohttp.ClientError:
+                pass
+        ready_rss = metrics["betbro_rss_bytes"]
+        # Member chunking and caches keep growing after READY; sample again once settled
+        await asyncio.sleep(args.gateway_settle)
+        async with session.get(url) as resp:
+            settled = parse_metrics(await resp.text())
+        return {
+            "ready_s": metrics["betbro_ready_seconds"],
+            "rss_ready_mb": ready_rss / 1048576,
+            "rss_settled_mb": settled["betbro_rss_bytes"] / 1048576,
+        }
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+
+async def gateway_compare(args) -> dict:
+    # One at a time, so the two runs don't compete for the gateway or the host
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+        return {
+            "full": await gateway_run(session, False, args),
+            "low_memory": await gateway_run(session, True, args),
+        }
+
+def print_gateway_report(report: dict):
+    print(f"{'mode':<12}{'ready s':>9}{'RSS at READY MB':>17}{'RSS settled MB':>16}")
+    for mode, r in report.items():
+        print(f"{mode:<12}{r['ready_s']:>9.1f}{r['rss_ready_mb']:>17.0f}{r['rss_settled_mb']:>16.0f}")
+
+def print_report(report: dict):
+    print(f"{report['ops']} ops in {report['elapsed_s']:.2f}s ({report['ops_per_s']:.0f} ops/s); "
+          f"drained {report['ipn_drained']} IPN events in {report['ipn_drain_s']:.2f}s")
+    print(f"{'command':<16}{'n':>7}{'p50 ms':>10}{'p99 ms':>10}{'pool wait':>11}{'queries':>9}{'errors':>8}")
+    for name, c in report["commands"].items():
+        print(f"{name:<16}{c['n']:>7}{c['p50_ms']:>10.2f}{c['p99_ms']:>10.2f}"
+              f"{c['pool_wait_ms']:>11.2f}{c['queries']:>9.2f}{c['errors']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for betbrobot handlers.")
+    parser.add_argument("--dsn", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="throwaway PostgreSQL DSN (default: $BENCH_DATABASE_URL)")
+    parser.add_argument("--ops", type=int, default=1000, help="total operations to replay")
+    parser.add_argument("--concurrency", type=int, default=20, help="operations in flight")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted command mix, name=weight,...")
+    parser.add_argument("--users", type=int, default=200, help="distinct fake users")
+    parser.add_argument("--pool-size", type=int, default=10, help="asyncpg pool size")
+    parser.add_argument("--discord-latency", type=float, default=0,
+                        help="simulated Discord REST latency per call, ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--max-p99", type=float,
+                        help="exit non-zero if any command's p99 exceeds this many ms")
+    parser.add_argument("--gateway-compare", action="store_true",
+                        help="compare startup time and RSS of the real gateway with LOW_MEMORY=0 and 1")
+    parser.add_argument("--gateway-port", type=int, default=8099, help="metrics port for --gateway-compare")
+    parser.add_argument("--gateway-timeout", type=float, default=600, help="seconds to wait for READY")
+    parser.add_argument("--gateway-settle", type=float, default=60,
+                        help="seconds after READY before the second RSS sample")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("set --dsn or BENCH_DATABASE_URL to a throwaway database")
+
+    if args.gateway_compare:
+        if not os.getenv("DISCORD_TOKEN"):
+            parser.error("--gateway-compare needs DISCORD_TOKEN for a bot in a real guild")
+        try:
+            report = asyncio.run(gateway_compare(args))
+        except RuntimeError as e:
+            sys.exit(f"gateway comparison failed: {e}")
+        print_gateway_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        return
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.max_p99 is not None:
+        slow = [n for n, c in report["commands"].items() if c["p99_ms"] > args.max_p99]
+        if slow:
+            print(f"p99 over {args.max_p99}ms: {', '.join(slow)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
 import os
 import asyncio
+import contextlib
+import csv
+import functools
+import hashlib
+import hmac
+import io
+import json
 import random
+import re
+import resource
+import socket
 import string
+import sys
+import tempfile
+import time
+import traceback
 import zipfile
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl
 
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 import asyncpg
+import aiohttp
 from aiohttp import web
 
 # ---------- Configuration ----------
+STARTED_AT = time.monotonic()
 TOKEN = os.getenv("DISCORD_TOKEN")
 APPLICATION_ID = int(os.getenv("APPLICATION_ID", 1360186929580212334))  # Your bot's application (client) ID
 GUILD_ID = int(os.getenv("GUILD_ID", 1359204211224744106))
@@ -23,6 +41,86 @@ LEADERBOARD_CHANNEL_ID = int(os.getenv("LEADERBOARD_CHANNEL_ID", 135930000000000
 # Commission: 5% fee on total pot
 COMMISSION_RATE = 0.05
 
+# Leaderboard sizes and display-name cache
+ROLE_BOARD_SIZE = 5
+STATS_BOARD_SIZE = 10
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", 2048))
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", 3600))  # seconds
+
+# /profile read-model cache
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 4096))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 300))  # seconds
+
+# Payment reminders: DB page size, concurrent DMs and DMs per second
+REMINDER_PAGE_SIZE = int(os.getenv("REMINDER_PAGE_SIZE", 500))
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", 5))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", 5))
+
+# PayPal IPN: postback verification endpoint and async processing batches
+PAYPAL_VERIFY_URL = os.getenv("PAYPAL_VERIFY_URL", "https://ipnpb.paypal.com/cgi-bin/webscr")
+IPN_BATCH_SIZE = int(os.getenv("IPN_BATCH_SIZE", 50))
+IPN_POLL_SECONDS = float(os.getenv("IPN_POLL_SECONDS", 5))
+# Events PayPal won't verify are retried with exponential backoff, then given up on
+IPN_MAX_ATTEMPTS = int(os.getenv("IPN_MAX_ATTEMPTS", 20))
+IPN_MAX_BACKOFF = float(os.getenv("IPN_MAX_BACKOFF", 3600))  # seconds
+# How long a worker holds claimed events before another may take them over
+IPN_LEASE_SECONDS = float(os.getenv("IPN_LEASE_SECONDS", 60))
+
+# Stale wager sweeper: pending wagers expire after WAGER_EXPIRY_HOURS; closed
+# (resolved/expired) wagers move to the archive tables after ARCHIVE_AFTER_DAYS
+WAGER_EXPIRY_HOURS = float(os.getenv("WAGER_EXPIRY_HOURS", 72))
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", 500))
+SWEEP_MINUTES = float(os.getenv("SWEEP_MINUTES", 10))
+
+# Coin ledger compaction: how often the leader folds ledger rows into users
+LEDGER_COMPACT_SECONDS = float(os.getenv("LEDGER_COMPACT_SECONDS", 60))
+LEDGER_COMPACT_BATCH = int(os.getenv("LEDGER_COMPACT_BATCH", 5000))
+
+# rank-logs catch-up: messages validated and applied per batch on startup/reconnect
+RANK_REPLAY_BATCH = int(os.getenv("RANK_REPLAY_BATCH", 100))
+
+# Export: bearer token for GET /export (endpoint disabled when unset)
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+EXPORT_FLUSH_BYTES = 256 * 1024
+
+# Batches larger than this are COPYed into a temp table before resolving
+RESOLVE_COPY_THRESHOLD = int(os.getenv("RESOLVE_COPY_THRESHOLD", 200))
+
+# Process layout: "all" runs everything in one process; "gateway" runs the
+# Discord client (optionally a subset of shards); "ipn" runs only the webhook
+# and IPN processing. Processes coordinate over Postgres LISTEN/NOTIFY.
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) or None
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()] or None
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+WEB_PORT = int(os.getenv("PORT", 8080))
+LEADER_CHECK_SECONDS = float(os.getenv("LEADER_CHECK_SECONDS", 10))
+
+# Channel posts: how long to gather a burst before sending, and retry policy
+DISPATCH_LINGER = float(os.getenv("DISPATCH_LINGER", 0.1))  # seconds
+DISPATCH_RETRIES = int(os.getenv("DISPATCH_RETRIES", 5))
+DISPATCH_MAX_BACKOFF = float(os.getenv("DISPATCH_MAX_BACKOFF", 30))  # seconds
+
+# Low-memory gateway: minimal intents, no member chunking or member cache;
+# members are fetched on demand into a bounded LRU instead.
+LOW_MEMORY = os.getenv("LOW_MEMORY", "0") == "1"
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 1024))
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", 900))  # seconds
+
+# Command execution: default per-command concurrency, and how the pool is
+# budgeted. Every pool user draws from one of these, and they must add up to at
+# most DB_POOL_SIZE, so high-priority commands and IPN always find a connection.
+COMMAND_CONCURRENCY = int(os.getenv("COMMAND_CONCURRENCY", 4))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+COMMAND_DB_SLOTS = int(os.getenv("COMMAND_DB_SLOTS", 8))    # ordinary and low-priority commands
+PRIORITY_DB_SLOTS = int(os.getenv("PRIORITY_DB_SLOTS", 4))  # confirmpayment, confirmwager, dispute
+JOB_DB_SLOTS = int(os.getenv("JOB_DB_SLOTS", 4))            # rank-logs, sweeper, compactor, reminders, events
+IPN_DB_RESERVE = int(os.getenv("IPN_DB_RESERVE", 3))        # one for the IPN worker, the rest for the webhook
+EXPORT_DB_SLOTS = int(os.getenv("EXPORT_DB_SLOTS", 1))      # concurrent /export downloads
+COMMAND_QUEUE_TIMEOUT = float(os.getenv("COMMAND_QUEUE_TIMEOUT", 10))  # seconds
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", 20))  # queued commands before low priority is shed
+
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
 if DATABASE_URL:
@@ -45,13 +143,341 @@ else:
     }
 
 # ---------- Bot & Database ----------
-intents = discord.Intents.all()
-bot = commands.Bot(
-    command_prefix="!",
-    intents=intents,
-    application_id=APPLICATION_ID
-)
+if LOW_MEMORY:
+    # Roles/channels, rank-logs messages and their content; nothing else.
+    intents = discord.Intents(guilds=True, guild_messages=True, message_content=True)
+    client_options = {
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False,
+        "max_messages": None,
+    }
+else:
+    intents = discord.Intents.all()
+    client_options = {}
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        application_id=APPLICATION_ID,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS,
+        **client_options
+    )
+else:
+    bot = commands.Bot(
+        command_prefix="!",
+        intents=intents,
+        application_id=APPLICATION_ID,
+        **client_options
+    )
 db_pool: asyncpg.Pool
+db_ready = asyncio.Event()  # set once the pool is open, migrated and caches are warm
+
+# ---------- Metrics ----------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(k)} {v}" for k, v in self._values.items()]
+        return lines
+
+class Gauge:
+    # Either set() explicitly or given a callback that is read at scrape time.
+    def __init__(self, name: str, help: str, read=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if self.read:
+            try:
+                self.set(self.read())
+            except Exception:
+                pass
+        lines += [f"{self.name}{_labels(k)} {v}" for k, v in self._values.items()]
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, n) in self._series.items():
+            for bound, c in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(key, (('le', bound),))} {c}")
+            lines.append(f"{self.name}_bucket{_labels(key, (('le', '+Inf'),))} {n}")
+            lines.append(f"{self.name}_sum{_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_labels(key)} {n}")
+        return lines
+
+COMMAND_SECONDS = Histogram("betbro_command_seconds", "App command latency.")
+IPN_SECONDS = Histogram("betbro_ipn_seconds", "PayPal IPN request handling latency.")
+TASK_SECONDS = Histogram("betbro_task_seconds", "Background job run time.")
+ERRORS = Counter("betbro_errors_total", "Unhandled errors by source and exception type.")
+DB_ACQUIRE_SECONDS = Histogram("betbro_db_acquire_seconds", "Time spent waiting for a pool connection.")
+DB_WAITING = Gauge("betbro_db_pool_waiting", "Tasks currently waiting for a pool connection.")
+DB_IN_USE = Gauge("betbro_db_pool_in_use", "Pool connections currently checked out.",
+                  lambda: db_pool.get_size() - db_pool.get_idle_size())
+DB_SIZE = Gauge("betbro_db_pool_size", "Pool connections currently open.", lambda: db_pool.get_size())
+DB_MAX_SIZE = Gauge("betbro_db_pool_max_size", "Pool connection limit.", lambda: db_pool.get_max_size())
+DISCORD_SECONDS = Histogram("betbro_discord_request_seconds", "Discord REST request latency by route.")
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current RSS; kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+RSS_BYTES = Gauge("betbro_rss_bytes", "Resident memory of this process.", current_rss_bytes)
+READY_SECONDS = Gauge("betbro_ready_seconds", "Seconds from process start to first gateway READY.")
+FIRST_COMMAND_SECONDS = Gauge("betbro_first_command_seconds",
+                              "Seconds from process start to the first completed app command.")
+
+METRICS = [RSS_BYTES, READY_SECONDS, FIRST_COMMAND_SECONDS, COMMAND_SECONDS, IPN_SECONDS, TASK_SECONDS, ERRORS, DB_ACQUIRE_SECONDS, DB_WAITING,
+           DB_IN_USE, DB_SIZE, DB_MAX_SIZE, DISCORD_SECONDS]
+
+def render_metrics() -> str:
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+@contextlib.contextmanager
+def timed(hist: Histogram, source: str, **labels):
+    # Records run time, and counts any escaping exception against `source`.
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ERRORS.inc(source=source, error=type(e).__name__)
+        raise
+    finally:
+        hist.observe(time.perf_counter() - started, **labels)
+
+class _TimedAcquire:
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        DB_WAITING.inc()
+        try:
+            return await self.ctx.__aenter__()
+        finally:
+            DB_WAITING.inc(-1)
+            DB_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+
+    async def __aexit__(self, *exc):
+        return await self.ctx.__aexit__(*exc)
+
+class InstrumentedPool:
+    # Wraps the asyncpg pool so every acquire, including those behind the
+    # pool-level query shortcuts, feeds the acquire-wait metrics.
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self, *args, **kwargs):
+        return _TimedAcquire(self._pool.acquire(*args, **kwargs))
+
+    async def execute(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.executemany(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchval(*args, **kwargs)
+
+def instrument_discord_http(http):
+    request = http.request
+
+    async def timed_request(route, *args, **kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await request(route, *args, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        finally:
+            DISCORD_SECONDS.observe(time.perf_counter() - started,
+                                    method=route.method, route=route.path, status=status)
+    http.request = timed_request
+
+instrument_discord_http(bot.http)
+
+async def reply_error(interaction: discord.Interaction, message: str, public: bool = False):
+    # The first response may already have gone out, or the interaction may be
+    # past its window; either way don't raise a second time. After a public
+    # deferral the first followup would fill the public placeholder, so that
+    # is deleted first and the error goes out as its own ephemeral message.
+    if public and interaction.response.is_done():
+        with contextlib.suppress(discord.HTTPException):
+            await interaction.delete_original_response()
+    try:
+        if interaction.response.is_done():
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+    except discord.HTTPException:
+        pass
+
+class CommandBusy(Exception):
+    pass
+
+class CommandGate:
+    # A concurrency limit whose queue depth is visible for load shedding.
+    # timeout=None waits as long as it takes.
+    def __init__(self, limit: int, timeout: float = COMMAND_QUEUE_TIMEOUT):
+        self._sem = asyncio.Semaphore(limit)
+        self.timeout = timeout
+        self.waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise CommandBusy("timeout") from None
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self._sem.release()
+
+command_gates = []
+command_slots = CommandGate(COMMAND_DB_SLOTS)
+priority_slots = CommandGate(PRIORITY_DB_SLOTS)
+job_slots = CommandGate(JOB_DB_SLOTS, timeout=None)
+ipn_slots = CommandGate(max(IPN_DB_RESERVE - 1, 1), timeout=None)
+export_slots = CommandGate(EXPORT_DB_SLOTS, timeout=None)
+
+def check_db_budget():
+    budget = COMMAND_DB_SLOTS + PRIORITY_DB_SLOTS + JOB_DB_SLOTS + IPN_DB_RESERVE + EXPORT_DB_SLOTS
+    if budget > DB_POOL_SIZE:
+        raise SystemExit(
+            f"DB budget {budget} (COMMAND_DB_SLOTS + PRIORITY_DB_SLOTS + JOB_DB_SLOTS + "
+            f"IPN_DB_RESERVE + EXPORT_DB_SLOTS) exceeds DB_POOL_SIZE {DB_POOL_SIZE}"
+        )
+
+def queued_commands() -> int:
+    return command_slots.waiting + priority_slots.waiting + sum(g.waiting for g in command_gates)
+
+COMMAND_QUEUE_SECONDS = Histogram("betbro_command_queue_seconds", "Time commands wait for a slot.")
+COMMANDS_QUEUED = Gauge("betbro_commands_queued", "Commands waiting for a slot.", queued_commands)
+COMMANDS_SHED = Counter("betbro_commands_shed_total", "Commands turned away by reason (shed, timeout).")
+METRICS += [COMMAND_QUEUE_SECONDS, COMMANDS_QUEUED, COMMANDS_SHED]
+
+@contextlib.asynccontextmanager
+async def admit(name: str, gate: CommandGate, priority: str):
+    if priority == "low" and queued_commands() >= SHED_QUEUE_DEPTH:
+        raise CommandBusy("shed")
+    started = time.perf_counter()
+    shared = priority_slots.slot() if priority == "high" else command_slots.slot()
+    async with gate.slot(), shared:
+        COMMAND_QUEUE_SECONDS.observe(time.perf_counter() - started, command=name)
+        yield
+
+first_command_after = None
+
+def instrumented(name: str, error_message: str, limit: int = COMMAND_CONCURRENCY,
+                 priority: str = "normal", ephemeral: bool = True):
+    # Wraps an app command: acknowledges the interaction before any queueing or
+    # DB work, runs it under its own concurrency limit plus the shared DB
+    # budget for its priority, and sheds "low" priority commands when
+    # the queues are deep. Handlers answer with interaction.followup.send.
+    # Also records latency and error counts, and sends the generic error reply.
+    gate = CommandGate(limit)
+    command_gates.append(gate)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+            global first_command_after
+            try:
+                with timed(COMMAND_SECONDS, name, command=name):
+                    try:
+                        await interaction.response.defer(ephemeral=ephemeral)
+                    except discord.NotFound:
+                        return  # expired before we could acknowledge it
+                    try:
+                        async with admit(name, gate, priority):
+                            # The gateway can come up before the pool does
+                            await db_ready.wait()
+                            result = await func(interaction, *args, **kwargs)
+                    except CommandBusy as e:
+                        COMMANDS_SHED.inc(command=name, reason=str(e))
+                        await reply_error(interaction, "⏳ The bot is busy, try again shortly.", not ephemeral)
+                        return
+            except Exception:
+                # timed() only counts it; keep the traceback for diagnosis
+                print(f"❌ Command {name} failed:")
+                traceback.print_exc()
+                await reply_error(interaction, error_message, not ephemeral)
+                return
+            if first_command_after is None:
+                first_command_after = time.monotonic() - STARTED_AT
+                FIRST_COMMAND_SECONDS.set(first_command_after)
+            return result
+        return wrapper
+    return decorator
 
 # ---------- Helper Functions ----------
 def generate_wager_id() -> str:
@@ -66,6 +492,616 @@ def get_stats_rank(wins: int, coins: float) -> str:
         return "Hustler"
     return "Rookie"
 
+STATE_UPSERT_SQL = """
+INSERT INTO bot_state(key,value) VALUES($1,$2)
+ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=now()
+"""
+
+async def get_state(key: str):
+    return await db_pool.fetchval("SELECT value FROM bot_state WHERE key=$1", key)
+
+async def set_state(key: str, value: str):
+    await db_pool.execute(STATE_UPSERT_SQL, key, value)
+
+# ---------- Caches ----------
+class TTLCache:
+    # Size-bounded LRU whose entries expire `ttl` seconds after being set.
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key, self._MISSING)
+        if item is self._MISSING:
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+display_names = TTLCache(NAME_CACHE_SIZE, NAME_CACHE_TTL)
+
+async def get_display_names(user_ids) -> dict:
+    # Cache first, then the gateway user cache; only unseen users hit REST,
+    # and those are fetched together rather than one after another.
+    names, missing = {}, []
+    for uid in user_ids:
+        name = display_names.get(uid)
+        if name is None:
+            u = bot.get_user(uid)
+            if u:
+                name = u.display_name
+                display_names.set(uid, name)
+        if name is None:
+            missing.append(uid)
+        else:
+            names[uid] = name
+    if missing:
+        fetched = await asyncio.gather(
+            *(bot.fetch_user(uid) for uid in missing), return_exceptions=True
+        )
+        for uid, u in zip(missing, fetched):
+            if isinstance(u, Exception):
+                names[uid] = str(uid)
+            else:
+                names[uid] = u.display_name
+                display_names.set(uid, u.display_name)
+    return names
+
+member_cache = TTLCache(MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL)
+
+async def get_member(guild: discord.Guild, uid: int):
+    # Gateway cache when it has the member (full mode), else the LRU, else REST.
+    member = guild.get_member(uid) or member_cache.get((guild.id, uid))
+    if member is None:
+        try:
+            member = await guild.fetch_member(uid)
+        except discord.NotFound:
+            return None
+        member_cache.set((guild.id, uid), member)
+    return member
+
+# ---------- Coin Ledger ----------
+# Resolutions append wins/losses/coins deltas to coin_ledger instead of
+# updating users in place. users is a snapshot of every compacted ledger row;
+# a balance is the snapshot plus the uncompacted tail.
+LEDGER_TAIL_SQL = (
+    "SELECT user_id, SUM(wins)::int AS wins, SUM(losses)::int AS losses, SUM(coins) AS coins "
+    "FROM coin_ledger WHERE NOT compacted GROUP BY user_id"
+)
+
+# Claims a batch of tail rows, marks them compacted and adds them to the
+# snapshot in one transaction, so readers never count a delta twice or not at all.
+COMPACT_LEDGER_SQL = """
+WITH batch AS (
+    SELECT id FROM coin_ledger WHERE NOT compacted ORDER BY id LIMIT $1
+    FOR UPDATE SKIP LOCKED
+), folded AS (
+    UPDATE coin_ledger l SET compacted=TRUE FROM batch b WHERE l.id=b.id
+    RETURNING l.user_id, l.wins, l.losses, l.coins
+), snapshot AS (
+    INSERT INTO users(user_id,wins,losses,coins)
+    SELECT user_id, SUM(wins), SUM(losses), SUM(coins) FROM folded GROUP BY user_id ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET wins=users.wins+EXCLUDED.wins,
+        losses=users.losses+EXCLUDED.losses, coins=users.coins+EXCLUDED.coins
+)
+SELECT count(*) FROM folded
+"""
+
+@tasks.loop(seconds=LEDGER_COMPACT_SECONDS)
+async def compact_ledger():
+    # Leader only: one writer for the users snapshot
+    if not coordinator.is_leader:
+        return
+    # tasks.loop stops for good on errors it doesn't consider transient, so
+    # one failed tick must not end compaction while we still hold the lock.
+    try:
+        with timed(TASK_SECONDS, "ledger_compactor", task="ledger_compactor"):
+            async with job_slots.slot():
+                while await db_pool.fetchval(COMPACT_LEDGER_SQL, LEDGER_COMPACT_BATCH) >= LEDGER_COMPACT_BATCH:
+                    pass
+    except Exception as e:
+        print(f"❌ Ledger compactor: {e!r}")
+
+# ---------- Leaderboards ----------
+# Shared with the user_ranks expression index so the planner can match it.
+ROLE_RANK_EXPR = "(CASE rank WHEN 'N/A' THEN 0 ELSE CAST(SUBSTRING(rank,2) AS INT) END)"
+ROLE_TIER_EXPR = "(CASE tier WHEN 'none' THEN 0 WHEN 'low' THEN 1 WHEN 'mid' THEN 2 ELSE 3 END)"
+ROLE_ORDER_SQL = f"{ROLE_RANK_EXPR} DESC, {ROLE_TIER_EXPR} DESC"
+TIER_ORDER = {"none": 0, "low": 1, "mid": 2}
+
+def role_sort_key(row) -> tuple:
+    # Python mirror of ROLE_ORDER_SQL
+    rank = 0 if row["rank"] == "N/A" else int(row["rank"][1:])
+    return rank, TIER_ORDER.get(row["tier"], 3)
+
+class Leaderboard:
+    # In-process top-N kept current by the writers. A miss costs one query;
+    # after that boards are served from memory until something forces a reload.
+    def __init__(self, size: int, query: str, key):
+        self.size = size
+        self.query = query
+        self.key = key
+        self.rows = None
+        self._gen = 0
+
+    def invalidate(self):
+        self.rows = None
+        self._gen += 1
+
+    async def top(self) -> list:
+        if self.rows is None:
+            gen = self._gen
+            rows = [dict(r) for r in await db_pool.fetch(self.query, self.size)]
+            if gen != self._gen:
+                # A writer raced the load; serve it but don't keep it.
+                return rows
+            self.rows = rows
+        return self.rows
+
+    def update(self, row: dict):
+        self._gen += 1
+        if self.rows is None:
+            return
+        uid = row["user_id"]
+        old = next((r for r in self.rows if r["user_id"] == uid), None)
+        if old is not None and len(self.rows) >= self.size and self.key(row) < self.key(old):
+            # Someone outside the cached top-N may now outrank this user.
+            self.rows = None
+            return
+        rows = [r for r in self.rows if r["user_id"] != uid]
+        rows.append(row)
+        rows.sort(key=self.key, reverse=True)
+        self.rows = rows[:self.size]
+
+role_board = Leaderboard(
+    ROLE_BOARD_SIZE,
+    f"SELECT user_id,rank,tier FROM user_ranks ORDER BY {ROLE_ORDER_SQL} LIMIT $1",
+    role_sort_key,
+)
+# Only tail users' balances can have moved, so the true top N lies within
+# the snapshot's top N + |tail| plus the tail users themselves.
+stats_board = Leaderboard(
+    STATS_BOARD_SIZE,
+    f"""
+WITH tail AS ({LEDGER_TAIL_SQL}), candidates AS (
+    (SELECT user_id FROM users ORDER BY coins DESC LIMIT $1 + (SELECT count(*) FROM tail))
+    UNION SELECT user_id FROM tail
+)
+SELECT c.user_id, COALESCE(u.coins,0)+COALESCE(t.coins,0) AS coins,
+       COALESCE(u.wins,0)+COALESCE(t.wins,0) AS wins
+FROM candidates c LEFT JOIN users u ON u.user_id=c.user_id LEFT JOIN tail t ON t.user_id=c.user_id
+ORDER BY coins DESC, c.user_id LIMIT $1
+""",
+    lambda r: r["coins"],
+)
+
+# ---------- Profiles ----------
+PROFILE_SQL = (
+    "SELECT COALESCE(u.wins,0)+t.wins AS wins, COALESCE(u.losses,0)+t.losses AS losses, "
+    "COALESCE(u.coins,0)+t.coins AS coins, r.rank, r.tier FROM (SELECT $1::bigint AS user_id) k "
+    "LEFT JOIN users u ON u.user_id=k.user_id "
+    "LEFT JOIN user_ranks r ON r.user_id=k.user_id "
+    "CROSS JOIN LATERAL (SELECT COALESCE(SUM(wins),0)::int AS wins, COALESCE(SUM(losses),0)::int AS losses, "
+    "COALESCE(SUM(coins),0) AS coins FROM coin_ledger l WHERE l.user_id=k.user_id AND NOT l.compacted) t"
+)
+
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+_profile_gen = 0
+
+def invalidate_profiles(*user_ids):
+    global _profile_gen
+    _profile_gen += 1
+    for uid in user_ids:
+        profile_cache.pop(uid)
+
+async def get_profile(user_id: int) -> dict:
+    p = profile_cache.get(user_id)
+    if p is None:
+        gen = _profile_gen
+        r = await db_pool.fetchrow(PROFILE_SQL, user_id)
+        wins, losses, coins = r['wins'] or 0, r['losses'] or 0, r['coins'] or 0
+        p = {
+            "wins": wins, "losses": losses, "coins": coins,
+            "rank": r['rank'] or 'N/A', "tier": r['tier'] or 'none',
+            "stats_rank": get_stats_rank(wins, coins),
+        }
+        # Don't cache a row an invalidation may have overtaken mid-fetch.
+        if gen == _profile_gen:
+            profile_cache.set(user_id, p)
+    return p
+
+# ---------- Rank Logs ----------
+RANK_PATTERN = re.compile(
+    r"<@!?(\d+)>\s+(N/A|R[1-9]|R10)(?:\s+(low|mid|high))?"
+    r"\s+to\s+(N/A|R[1-9]|R10)(?:\s+(low|mid|high))?",
+    re.IGNORECASE,
+)
+
+# user_id -> (rank, tier), loaded at startup and written through on every change
+rank_cache: dict = {}
+# guild_id -> {role name: Role}, rebuilt on role create/update/delete
+role_index: dict = {}
+# Serializes validate-then-apply so two messages for one user can't both pass
+rank_lock = asyncio.Lock()
+# channel_id -> id of the last rank-logs message applied (or rejected)
+rank_checkpoints: dict = {}
+# Bumped whenever the gateway connection drops or comes back. A channel whose
+# last replay predates the current generation replays before any live message
+# is applied, so a message arriving ahead of the catch-up can't skip the gap.
+rank_log_gen = 0
+rank_replayed_gen: dict = {}
+NO_RANK = ('N/A', 'none')
+
+# Upserts the final ranks and advances the channel checkpoint in one statement;
+# the checkpoint only ever moves forward.
+SAVE_RANKS_SQL = """
+WITH ranks AS (
+    INSERT INTO user_ranks(user_id,rank,tier)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[])
+    ON CONFLICT (user_id) DO UPDATE SET rank=EXCLUDED.rank, tier=EXCLUDED.tier
+)
+INSERT INTO bot_state(key,value) VALUES($4,$5)
+ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=now()
+WHERE bot_state.value::bigint < EXCLUDED.value::bigint
+"""
+
+def parse_rank_change(content: str):
+    m = RANK_PATTERN.match(content)
+    if not m:
+        return None
+    uid, pr, pt, nr, nt = m.groups()
+    return int(uid), pr.upper(), (pt or "none").lower(), nr.upper(), (nt or "none").lower()
+
+def rebuild_role_index(guild: discord.Guild):
+    # Reversed so the first role with a given name wins, like discord.utils.get.
+    role_index[guild.id] = {r.name: r for r in reversed(guild.roles)}
+
+async def load_rank_cache():
+    rows = await db_pool.fetch('SELECT user_id,rank,tier FROM user_ranks')
+    rank_cache.clear()
+    rank_cache.update({r['user_id']: (r['rank'], r['tier']) for r in rows})
+
+def rank_checkpoint_key(channel_id: int) -> str:
+    return f"rank_logs:{channel_id}"
+
+def rank_roles(roles: dict, rank: str, tier: str) -> set:
+    if rank == 'N/A':
+        return set()
+    return {r for r in (roles.get(rank), roles.get(tier)) if r}
+
+async def set_member_ranks(guild: discord.Guild, uid: int, old: tuple, new: tuple):
+    member = await get_member(guild, uid)
+    if not member:
+        return
+    roles = role_index.get(guild.id, {})
+    before, after = rank_roles(roles, *old), rank_roles(roles, *new)
+    if before - after:
+        await member.remove_roles(*(before - after))
+    if after - before:
+        await member.add_roles(*(after - before))
+
+async def save_rank_changes(channel_id: int, message_id: int, ranks: dict):
+    uids = list(ranks)
+    await db_pool.execute(
+        SAVE_RANKS_SQL, uids, [ranks[u][0] for u in uids], [ranks[u][1] for u in uids],
+        rank_checkpoint_key(channel_id), str(message_id)
+    )
+    rank_checkpoints[channel_id] = max(rank_checkpoints.get(channel_id, 0), message_id)
+    for uid, (rank, tier) in ranks.items():
+        rank_cache[uid] = (rank, tier)
+        role_board.update({"user_id": uid, "rank": rank, "tier": tier})
+        publish("rank", user_id=uid, rank=rank, tier=tier)
+    invalidate_profiles(*ranks)
+
+async def apply_rank_batch(channel: discord.TextChannel, messages: list):
+    # Walks the chain of transitions in memory, then makes one role edit per
+    # user (first state -> last state) and one DB round trip for the batch.
+    state, origin, lines = {}, {}, []
+    for msg in messages:
+        change = None if msg.author.bot else parse_rank_change(msg.content)
+        if not change:
+            continue
+        uid, pr, pt, nr, nt = change
+        cur = state.get(uid) or rank_cache.get(uid, NO_RANK)
+        if cur != (pr, pt):
+            lines.append(f"❌ <@{uid}> has {cur[0]} {cur[1]}, not {pr} {pt}.")
+            continue
+        origin.setdefault(uid, cur)
+        state[uid] = (nr, nt)
+        lines.append(f"✅ Updated <@{uid}> to {nr} {nt}.")
+    results = await asyncio.gather(
+        *(set_member_ranks(channel.guild, uid, origin[uid], new) for uid, new in state.items() if new != origin[uid]),
+        return_exceptions=True
+    )
+    failed = sum(isinstance(r, Exception) for r in results)
+    if failed:
+        # The DB stays the source of truth; the next live change fixes the roles
+        print(f"⚠️ rank-logs replay: {failed} role edits failed in #{channel.name}")
+    await save_rank_changes(channel.id, messages[-1].id, state)
+    for line in lines:
+        dispatcher.post(channel.id, content=line)
+
+def mark_rank_logs_stale():
+    global rank_log_gen
+    rank_log_gen += 1
+
+async def replay_rank_logs(channel: discord.TextChannel) -> int:
+    # Caller holds rank_lock. Applies everything after the stored checkpoint.
+    rank_replayed_gen[channel.id] = rank_log_gen
+    after = await get_state(rank_checkpoint_key(channel.id))
+    if after is None:
+        # First run for this channel: start from process start rather than
+        # replaying history that was handled before checkpoints existed.
+        started = discord.utils.utcnow() - timedelta(seconds=time.monotonic() - STARTED_AT)
+        after = discord.utils.time_snowflake(started)
+        await save_rank_changes(channel.id, after, {})
+    after = int(after)
+    rank_checkpoints[channel.id] = max(rank_checkpoints.get(channel.id, 0), after)
+    batch, seen = [], 0
+    async for msg in channel.history(limit=None, after=discord.Object(id=after), oldest_first=True):
+        batch.append(msg)
+        if len(batch) >= RANK_REPLAY_BATCH:
+            await apply_rank_batch(channel, batch)
+            seen, batch = seen + len(batch), []
+    if batch:
+        await apply_rank_batch(channel, batch)
+        seen += len(batch)
+    return seen
+
+async def catch_up_rank_logs():
+    await db_ready.wait()
+    for guild in bot.guilds:
+        channel = discord.utils.get(guild.text_channels, name="rank-logs")
+        if channel is None:
+            continue
+        with timed(TASK_SECONDS, "rank_replay", task="rank_replay"):
+            async with job_slots.slot(), rank_lock:
+                seen = await replay_rank_logs(channel)
+        if seen:
+            print(f"🔁 Caught up {seen} rank-logs messages in {guild.name}")
+
+async def apply_rank_message(message: discord.Message):
+    change = parse_rank_change(message.content)
+    if not change:
+        return
+    uid, pr, pt, nr, nt = change
+    async with rank_lock:
+        if rank_replayed_gen.get(message.channel.id) != rank_log_gen:
+            # Not caught up since the last (re)connect; the replay covers this message too
+            await replay_rank_logs(message.channel)
+        if message.id <= rank_checkpoints[message.channel.id]:
+            return
+        cur_rank, cur_tier = rank_cache.get(uid, NO_RANK)
+        if cur_rank != pr or cur_tier != pt:
+            await save_rank_changes(message.channel.id, message.id, {})
+            return await message.channel.send(
+                f"❌ <@{uid}> has {cur_rank} {cur_tier}, not {pr} {pt}."
+            )
+        # Update Discord roles, then persist. As in apply_rank_batch the DB is
+        # the source of truth: a failed role edit (Forbidden, member left)
+        # still records the change and moves the checkpoint.
+        note = ""
+        try:
+            await set_member_ranks(message.guild, uid, (pr, pt), (nr, nt))
+        except Exception as e:
+            print(f"⚠️ rank-logs: role edit for {uid} failed in #{message.channel.name}: {e!r}")
+            note = " (role edit failed)"
+        await save_rank_changes(message.channel.id, message.id, {uid: (nr, nt)})
+    await message.channel.send(f"✅ Updated <@{uid}> to {nr} {nt}.{note}")
+
+# ---------- Cluster Coordination ----------
+EVENTS_CHANNEL = "betbro_events"
+NOTIFY_MAX_BYTES = 7999  # pg_notify rejects anything longer
+EVENT_ID_CHUNK = 200     # ids per event, comfortably under NOTIFY_MAX_BYTES
+LEADER_LOCK_ID = 0x62657463  # pg advisory lock key held by the singleton-job leader
+
+_background = set()
+
+def spawn(coro):
+    # Fire-and-forget that keeps a reference until the task finishes.
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+async def _notify(payload: str):
+    try:
+        async with job_slots.slot():
+            await db_pool.execute("SELECT pg_notify($1, $2)", EVENTS_CHANNEL, payload)
+    except Exception as e:
+        print(f"❌ Failed to publish event: {e!r}")
+
+def publish(kind: str, **data):
+    # Tell the other processes; never delays the caller.
+    payload = json.dumps({"kind": kind, "origin": WORKER_ID, **data})
+    if len(payload.encode()) > NOTIFY_MAX_BYTES:
+        # Can't be delivered as is; have everyone drop their caches instead
+        print(f"⚠️ '{kind}' event too large to publish ({len(payload.encode())} bytes); flushing caches")
+        payload = json.dumps({"kind": "flush", "origin": WORKER_ID})
+    spawn(_notify(payload))
+
+def publish_ids(kind: str, key: str, ids: list, **data):
+    for i in range(0, len(ids), EVENT_ID_CHUNK):
+        publish(kind, **data, **{key: ids[i:i + EVENT_ID_CHUNK]})
+
+def handle_event(event: dict):
+    kind = event["kind"]
+    if kind == "resolved":
+        invalidate_profiles(*event["user_ids"])
+        stats_board.invalidate()
+    elif kind == "rank":
+        uid = event["user_id"]
+        rank_cache[uid] = (event["rank"], event["tier"])
+        role_board.update({"user_id": uid, "rank": event["rank"], "tier": event["tier"]})
+        invalidate_profiles(uid)
+    elif kind == "wager_funded":
+        spawn(announce_funded(event["wager_id"], relay=False))
+    elif kind == "wagers_flagged":
+        announce_stale(event["wager_ids"], relay=False, late=event.get("late", False))
+    elif kind == "flush":
+        spawn(reset_caches())
+
+async def reset_caches():
+    # Anything published while we weren't listening is lost; start clean.
+    profile_cache.clear()
+    role_board.invalidate()
+    stats_board.invalidate()
+    async with job_slots.slot():
+        await load_rank_cache()
+
+class Coordinator:
+    # One dedicated session per process: it LISTENs for cross-process events
+    # and tries to hold the leader advisory lock. Losing the session drops the
+    # lock server-side, so another process takes over singleton jobs. Only
+    # processes that run every leader-only job may campaign for the lock.
+    def __init__(self, campaign: bool = True):
+        self.conn = None
+        self.campaign = campaign
+        self.is_leader = False
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+            if event.get("origin") != WORKER_ID:
+                handle_event(event)
+        except Exception as e:
+            print(f"❌ Bad event {payload!r}: {e!r}")
+
+    async def step(self):
+        if self.conn is None or self.conn.is_closed():
+            reconnect = self.conn is not None
+            self.is_leader = False
+            self.conn = await asyncpg.connect(**DB_CONFIG)
+            await self.conn.add_listener(EVENTS_CHANNEL, self._on_notify)
+            if reconnect:
+                await reset_caches()
+        if self.is_leader or not self.campaign:
+            await self.conn.execute("SELECT 1")
+        else:
+            self.is_leader = await self.conn.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_ID)
+            if self.is_leader:
+                print(f"👑 {WORKER_ID} is now the job leader")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(LEADER_CHECK_SECONDS)
+            try:
+                await self.step()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                print(f"❌ Coordinator connection lost: {e!r}")
+                self.is_leader = False
+                if self.conn is not None and not self.conn.is_closed():
+                    self.conn.terminate()
+
+# IPN-only processes don't run the reminder loop, so they must never hold the lock
+coordinator = Coordinator(campaign=BOT_ROLE != "ipn")
+
+# ---------- Channel Dispatch ----------
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+MAX_CONTENT_CHARS = 2000
+
+DISPATCH_QUEUED = Gauge("betbro_dispatch_queued", "Channel posts waiting to be sent.")
+DISPATCH_MESSAGES = Counter("betbro_dispatch_messages_total", "Messages sent by the channel dispatcher.")
+METRICS += [DISPATCH_QUEUED, DISPATCH_MESSAGES]
+
+def pack_posts(posts: list) -> list:
+    # Folds queued (content, embed) posts, in order, into as few messages as
+    # Discord's per-message content and embed limits allow.
+    messages, lines, embeds, embed_chars = [], [], [], 0
+    for content, embed in posts:
+        size = len(embed) if embed else 0
+        text_full = content and len("\n".join(lines + [content])) > MAX_CONTENT_CHARS
+        embeds_full = embed and (len(embeds) == MAX_EMBEDS_PER_MESSAGE
+                                 or embed_chars + size > MAX_EMBED_CHARS_PER_MESSAGE)
+        if (text_full or embeds_full) and (lines or embeds):
+            messages.append(("\n".join(lines) or None, embeds))
+            lines, embeds, embed_chars = [], [], 0
+        if content:
+            lines.append(content)
+        if embed:
+            embeds.append(embed)
+            embed_chars += size
+    if lines or embeds:
+        messages.append(("\n".join(lines) or None, embeds))
+    return messages
+
+class ChannelDispatcher:
+    # One queue and sender task per channel, so posting never waits on
+    # Discord inside a command and a burst of posts becomes a few messages.
+    def __init__(self):
+        self._queues = {}
+
+    def post(self, channel_id: int, content: str = None, embed: discord.Embed = None):
+        q = self._queues.get(channel_id)
+        if q is None:
+            q = self._queues[channel_id] = asyncio.Queue()
+            spawn(self._run(channel_id, q))
+        q.put_nowait((content, embed))
+        DISPATCH_QUEUED.inc(channel=channel_id)
+
+    async def _run(self, channel_id: int, q: asyncio.Queue):
+        while True:
+            posts = [await q.get()]
+            await asyncio.sleep(DISPATCH_LINGER)
+            while not q.empty():
+                posts.append(q.get_nowait())
+            DISPATCH_QUEUED.inc(-len(posts), channel=channel_id)
+            try:
+                for content, embeds in pack_posts(posts):
+                    await self._send(channel_id, content, embeds)
+            except Exception as e:
+                # This task is the channel's only sender; keep it alive
+                ERRORS.inc(source="dispatch", error=type(e).__name__)
+                print(f"❌ Dropped posts to channel {channel_id}: {e!r}")
+
+    async def _send(self, channel_id: int, content, embeds: list):
+        attempts = 0
+        for attempt in range(DISPATCH_RETRIES):
+            attempts = attempt + 1
+            ch = bot.get_channel(channel_id)
+            if ch is None:
+                delay = min(DISPATCH_MAX_BACKOFF, 2 ** attempt)
+            else:
+                try:
+                    await ch.send(content=content, embeds=embeds)
+                    DISPATCH_MESSAGES.inc(channel=channel_id)
+                    return
+                except discord.RateLimited as e:
+                    delay = e.retry_after
+                except discord.HTTPException as e:
+                    if e.status != 429 and 400 <= e.status < 500:
+                        break  # won't succeed on retry (permissions, bad payload)
+                    delay = min(DISPATCH_MAX_BACKOFF, 2 ** attempt)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    delay = min(DISPATCH_MAX_BACKOFF, 2 ** attempt)
+            await asyncio.sleep(delay)
+        ERRORS.inc(source="dispatch", error="SendFailed")
+        print(f"❌ Dropped post to channel {channel_id} after {attempts} attempts")
+
+dispatcher = ChannelDispatcher()
+
 # ---------- Events ----------
 
 
@@ -75,90 +1111,563 @@ async def on_message(message: discord.Message):
     await bot.process_commands(message)
 
     # Role-logs parser
-    if message.channel.name == "rank-logs" and not message.author.bot:
-        import re
-        pattern = (
-            r"<@!?(\d+)>\s+(N/A|R[1-9]|R10)(?:\s+(low|mid|high))?"
-            r"\s+to\s+(N/A|R[1-9]|R10)(?:\s+(low|mid|high))?"
-        )
-        m = re.match(pattern, message.content, re.IGNORECASE)
-        if m:
-            uid, pr, pt, nr, nt = m.groups()
-            pr, nr = pr.upper(), nr.upper()
-            pt, nt = (pt or "none").lower(), (nt or "none").lower()
-            member = message.guild.get_member(int(uid))
-            async with db_pool.acquire() as conn:
-                rec = await conn.fetchrow(
-                    'SELECT rank,tier FROM user_ranks WHERE user_id=$1', int(uid)
-                )
-                cur_rank, cur_tier = (rec['rank'], rec['tier']) if rec else ('N/A','none')
-                if cur_rank != pr or cur_tier != pt:
-                    await message.channel.send(
-                        f"❌ <@{uid}> has {cur_rank} {cur_tier}, not {pr} {pt}."
-                    )
-                else:
-                    # Update Discord roles
-                    if pr != 'N/A':
-                        old_r = discord.utils.get(message.guild.roles, name=pr)
-                        old_t = discord.utils.get(message.guild.roles, name=pt)
-                        await member.remove_roles(*(r for r in (old_r, old_t) if r))
-                    if nr != 'N/A':
-                        new_r = discord.utils.get(message.guild.roles, name=nr)
-                        new_t = discord.utils.get(message.guild.roles, name=nt)
-                        await member.add_roles(*(r for r in (new_r, new_t) if r))
-                    # Persist to DB
-                    await conn.execute(
-                        'INSERT INTO user_ranks(user_id,rank,tier) VALUES($1,$2,$3) '
-                        'ON CONFLICT(user_id) DO UPDATE SET rank=$2,tier=$3',
-                        int(uid), nr, nt
-                    )
-                    await message.channel.send(f"✅ Updated <@{uid}> to {nr} {nt}.")
+    if getattr(message.channel, "name", None) == "rank-logs" and not message.author.bot:
+        with timed(TASK_SECONDS, "rank_logs", task="rank_logs"):
+            await db_ready.wait()
+            async with job_slots.slot():
+                await apply_rank_message(message)
+
+@bot.event
+async def on_guild_available(guild: discord.Guild):
+    rebuild_role_index(guild)
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    rebuild_role_index(role.guild)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    rebuild_role_index(after.guild)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    rebuild_role_index(role.guild)
 
 # ---------- Periodic Reminders ----------
+class RateLimiter:
+    # Token bucket: on average `rate` acquisitions per second, bursting to `burst`.
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Keyset page over unfunded pending wagers; same rows as the old
+# GROUP BY ... HAVING bool_and(paid)=FALSE query, one short query per page.
+PENDING_REMINDERS_SQL = (
+    "SELECT w.wager_id,w.p1_id,w.p2_id,w.amount_usd FROM wagers w "
+    "WHERE w.status='pending' AND w.wager_id > $1 "
+    "AND EXISTS (SELECT 1 FROM payments p WHERE p.wager_id=w.wager_id AND NOT p.paid) "
+    "ORDER BY w.wager_id LIMIT $2"
+)
+MAX_REMINDER_LINES = 20
+
+reminder_limiter = RateLimiter(REMINDER_RATE, burst=REMINDER_CONCURRENCY)
+
+async def collect_pending_reminders() -> dict:
+    # user_id -> [(wager_id, amount)], so each user gets a single DM per tick.
+    # The pool connection is only held for the duration of each page query.
+    pending, last = {}, ""
+    while True:
+        async with job_slots.slot():
+            rows = await db_pool.fetch(PENDING_REMINDERS_SQL, last, REMINDER_PAGE_SIZE)
+        for r in rows:
+            for uid in {r['p1_id'], r['p2_id']}:
+                pending.setdefault(uid, []).append((r['wager_id'], r['amount_usd']))
+        if len(rows) < REMINDER_PAGE_SIZE:
+            return pending
+        last = rows[-1]['wager_id']
+
+def format_reminder(items: list) -> str:
+    if len(items) == 1:
+        wid, amount = items[0]
+        return f"Reminder: complete payment of ${amount:.2f} for wager {wid}"
+    lines = [f"• ${amount:.2f} for wager {wid}" for wid, amount in items[:MAX_REMINDER_LINES]]
+    if len(items) > MAX_REMINDER_LINES:
+        lines.append(f"…and {len(items) - MAX_REMINDER_LINES} more")
+    return "Reminder: complete payment for your pending wagers:\n" + "\n".join(lines)
+
+async def send_reminder(sem: asyncio.Semaphore, uid: int, items: list) -> bool:
+    async with sem:
+        # discord.py handles per-route buckets and 429s; the limiter keeps the
+        # fan-out well under the global request budget shared with commands.
+        await reminder_limiter.acquire()
+        try:
+            # Users outside the gateway cache (always, in low-memory mode) get
+            # their DM channel opened directly rather than skipped.
+            dm = bot.get_user(uid) or await bot.create_dm(discord.Object(id=uid))
+            await dm.send(format_reminder(items))
+        except discord.HTTPException:
+            return False  # DMs closed or the user is gone
+        except Exception as e:
+            # Connection errors and timeouts included: one failed DM must not
+            # abort the tick, or tasks.loop reruns it and re-reminds everyone.
+            ERRORS.inc(source="reminders", error=type(e).__name__)
+            return False
+    return True
+
 @tasks.loop(minutes=30)
 async def periodic_reminders():
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            "SELECT w.wager_id,w.p1_id,w.p2_id,w.amount_usd FROM wagers w "
-            "JOIN payments p ON w.wager_id=p.wager_id "
-            "WHERE w.status='pending' "
-            "GROUP BY w.wager_id,w.p1_id,w.p2_id,w.amount_usd "
-            "HAVING bool_and(p.paid)=FALSE"
-        )
-        for r in rows:
-            for uid in (r['p1_id'], r['p2_id']):
-                user = bot.get_user(uid)
-                if user:
-                    await user.send(
-                        f"Reminder: complete payment of ${r['amount_usd']:.2f} for wager {r['wager_id']}"
-                    )
+    if not coordinator.is_leader:
+        return
+    try:
+        with timed(TASK_SECONDS, "reminders", task="reminders"):
+            await send_periodic_reminders()
+    except Exception as e:
+        print(f"❌ Reminders: {e!r}")
+
+async def send_periodic_reminders():
+    started = time.monotonic()
+    pending = await collect_pending_reminders()
+    sem = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    results = await asyncio.gather(
+        *(send_reminder(sem, uid, items) for uid, items in pending.items()),
+        return_exceptions=True
+    )
+    elapsed = time.monotonic() - started
+    sent = sum(r is True for r in results)
+    wagers = len({wid for items in pending.values() for wid, _ in items})
+    print(f"⏰ Reminders: {sent}/{len(pending)} users for {wagers} wagers "
+          f"in {elapsed:.1f}s ({sent / elapsed if elapsed else 0:.1f} DM/s)")
+
+# ---------- Wager Sweeper ----------
+WAGER_COLUMNS = (
+    "wager_id,host_id,p1_id,p2_id,amount_usd,is_supervised,vod_required,"
+    "mod_id,status,paypal_link_p1,commission,created_at"
+)
+PAYMENT_COLUMNS = "wager_id,user_id,paid"
+
+# SKIP LOCKED lets any number of instances sweep at once: each claims a
+# disjoint batch and rows a command is touching right now are left alone.
+STALE_WAGERS_SQL = """
+SELECT wager_id FROM wagers
+WHERE status='pending' AND flagged_at IS NULL AND created_at < now() - $1::interval
+ORDER BY created_at LIMIT $2
+FOR UPDATE SKIP LOCKED
+"""
+# Run after the batch is locked, so the payment check sees every committed
+# confirmation. Wagers with money in them are never written off: they are
+# flagged once for a mod instead.
+EXPIRE_WAGERS_SQL = """
+UPDATE wagers w SET status='expired'
+WHERE w.wager_id = ANY($1::text[])
+  AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.wager_id=w.wager_id AND p.paid)
+"""
+FLAG_WAGERS_SQL = """
+UPDATE wagers w SET flagged_at=now()
+WHERE w.wager_id = ANY($1::text[]) AND w.status='pending'
+RETURNING w.wager_id
+"""
+# Payment writers run this under the wager lock: money that arrives after
+# the sweeper wrote a wager off is flagged for a mod instead of going unseen.
+FLAG_LATE_PAYMENTS_SQL = """
+UPDATE wagers w SET flagged_at=now()
+WHERE w.wager_id = ANY($1::text[]) AND w.status='expired'
+RETURNING w.wager_id
+"""
+ARCHIVE_WAGERS_SQL = f"""
+WITH batch AS (
+    SELECT wager_id FROM wagers
+    WHERE status IN ('resolved','expired') AND created_at < now() - $1::interval
+    ORDER BY created_at LIMIT $2
+    FOR UPDATE SKIP LOCKED
+), moved_payments AS (
+    DELETE FROM payments p USING batch b WHERE p.wager_id=b.wager_id
+    RETURNING p.{PAYMENT_COLUMNS.replace(",", ",p.")}
+), archived_payments AS (
+    INSERT INTO payments_archive({PAYMENT_COLUMNS}) SELECT * FROM moved_payments
+), moved AS (
+    DELETE FROM wagers w USING batch b WHERE w.wager_id=b.wager_id
+    RETURNING w.{WAGER_COLUMNS.replace(",", ",w.")}
+)
+INSERT INTO wagers_archive({WAGER_COLUMNS}) SELECT * FROM moved
+"""
+
+SWEPT = Counter("betbro_swept_wagers_total", "Wagers expired, flagged or archived by the sweeper.")
+METRICS.append(SWEPT)
+
+def announce_stale(wager_ids: list, relay: bool = True, late: bool = False):
+    # Same hand-off as announce_funded: post if we can see the channel, else relay.
+    # late: the payment came in after the wager had already expired.
+    if bot.get_channel(MOD_RESULTS_CHANNEL_ID):
+        for wid in wager_ids:
+            if late:
+                message = f"⚠️ Payment received for wager {wid} after it expired; please review."
+            else:
+                message = f"⚠️ Wager {wid} is past its expiry but has payments received; please review."
+            dispatcher.post(MOD_RESULTS_CHANNEL_ID, message)
+    elif relay:
+        publish_ids("wagers_flagged", "wager_ids", wager_ids, late=late)
+
+async def expire_stale_wagers(age: timedelta) -> tuple:
+    expired, flagged = 0, 0
+    while True:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                wids = [r['wager_id'] for r in await conn.fetch(STALE_WAGERS_SQL, age, SWEEP_BATCH_SIZE)]
+                expired += int((await conn.execute(EXPIRE_WAGERS_SQL, wids)).split()[-1])
+                held = [r['wager_id'] for r in await conn.fetch(FLAG_WAGERS_SQL, wids)]
+        if held:
+            flagged += len(held)
+            announce_stale(held)
+        if len(wids) < SWEEP_BATCH_SIZE:
+            return expired, flagged
+
+async def sweep_batches(sql: str, age: timedelta) -> int:
+    # Bounded batches, each its own short transaction, until one comes back short.
+    total = 0
+    while True:
+        status = await db_pool.execute(sql, age, SWEEP_BATCH_SIZE)
+        n = int(status.split()[-1])
+        total += n
+        if n < SWEEP_BATCH_SIZE:
+            return total
+
+@tasks.loop(minutes=SWEEP_MINUTES)
+async def sweep_wagers():
+    # Like the compactor, a failed tick is logged and the next one retries.
+    try:
+        with timed(TASK_SECONDS, "sweeper", task="sweeper"):
+            async with job_slots.slot():
+                expired, flagged = await expire_stale_wagers(timedelta(hours=WAGER_EXPIRY_HOURS))
+                archived = await sweep_batches(ARCHIVE_WAGERS_SQL, timedelta(days=ARCHIVE_AFTER_DAYS))
+    except Exception as e:
+        print(f"❌ Sweeper: {e!r}")
+        return
+    SWEPT.inc(expired, action="expired")
+    SWEPT.inc(flagged, action="flagged")
+    SWEPT.inc(archived, action="archived")
+    if expired or flagged or archived:
+        print(f"🧹 Sweeper: expired {expired}, flagged {flagged}, archived {archived} wagers")
 
 # ---------- PayPal IPN Webhook ----------
+# Claims the events and marks their payments paid. Claiming on processed_at
+# IS NULL makes redelivered or concurrently processed events no-ops.
+CLAIM_IPN_SQL = """
+WITH ev AS (
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::bigint[], $4::bool[])
+        AS e(id, wager_id, user_id, valid)
+), claimed AS (
+    UPDATE ipn_events i
+    SET processed_at=now(), outcome=CASE WHEN ev.valid THEN 'verified' ELSE 'invalid' END
+    FROM ev WHERE i.id=ev.id AND i.processed_at IS NULL
+    RETURNING ev.wager_id, ev.user_id, ev.valid
+), pay AS (
+    UPDATE payments p SET paid=TRUE
+    FROM claimed c
+    WHERE c.valid AND p.wager_id=c.wager_id AND p.user_id=c.user_id AND NOT p.paid
+)
+SELECT DISTINCT wager_id FROM claimed WHERE valid
+"""
+# Every writer of payments locks the wager row first, so by the time this runs
+# (in a fresh READ COMMITTED snapshot) it sees every other committed payment.
+LOCK_WAGERS_SQL = "SELECT wager_id FROM wagers WHERE wager_id = ANY($1::text[]) ORDER BY wager_id FOR UPDATE"
+FUND_WAGERS_SQL = """
+UPDATE wagers w SET status='paid'
+WHERE w.wager_id = ANY($1::text[]) AND w.status='pending'
+  AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.wager_id=w.wager_id AND NOT p.paid)
+RETURNING w.wager_id
+"""
+# Leases a batch by pushing next_attempt_at past the verification round trip,
+# so concurrent IPN workers verify disjoint events. If the holder dies, the
+# lease runs out and the events are picked up again.
+IPN_BACKLOG_SQL = """
+UPDATE ipn_events SET next_attempt_at = now() + $2::float8 * interval '1 second'
+WHERE id IN (
+    SELECT id FROM ipn_events WHERE processed_at IS NULL AND next_attempt_at <= now()
+    ORDER BY id LIMIT $1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, body
+"""
+IPN_RETRY_SQL = """
+UPDATE ipn_events SET attempts=attempts+1,
+    next_attempt_at=now() + least($2::float8 * 2 ^ attempts, $3::float8) * interval '1 second',
+    processed_at=CASE WHEN attempts+1 >= $4 THEN now() END,
+    outcome=CASE WHEN attempts+1 >= $4 THEN 'unverifiable' END
+WHERE id = ANY($1::bigint[]) AND processed_at IS NULL
+"""
+
+http_session: aiohttp.ClientSession
+ipn_wakeup = asyncio.Event()
+
 async def handle_ipn(request):
-    data = await request.post()
-    if data.get('payment_status') == 'Completed':
-        wid = data.get('invoice')
-        pid = int(data.get('custom', 0))
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                'UPDATE payments SET paid=TRUE WHERE wager_id=$1 AND user_id=$2',
-                wid, pid
-            )
-            cnt = await conn.fetchval(
-                'SELECT COUNT(*) FROM payments WHERE wager_id=$1 AND paid=TRUE',
-                wid
+    with timed(IPN_SECONDS, "ipn"):
+        await db_ready.wait()
+        return await ingest_ipn(request)
+
+async def ingest_ipn(request):
+    # Persist and acknowledge; verification and the DB transition happen in ipn_worker.
+    body = await request.text()
+    data = dict(parse_qsl(body))
+    txn_id = data.get('txn_id')
+    if data.get('payment_status') == 'Completed' and txn_id:
+        async with ipn_slots.slot():
+            await db_pool.execute(
+                'INSERT INTO ipn_events(txn_id,body) VALUES($1,$2) ON CONFLICT (txn_id) DO NOTHING',
+                txn_id, body
             )
-            if cnt == 2:
-                await conn.execute(
-                    "UPDATE wagers SET status='paid' WHERE wager_id=$1", wid
-                )
-                ch = bot.get_channel(CONFIRM_CHANNEL_ID)
-                if ch:
-                    await ch.send(f"💵 Wager {wid} funded. Match on!")
+        ipn_wakeup.set()
     return web.Response(status=200)
 
+async def verify_ipn(body: str) -> bool:
+    async with http_session.post(
+        PAYPAL_VERIFY_URL,
+        data="cmd=_notify-validate&" + body,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    ) as resp:
+        resp.raise_for_status()
+        return (await resp.text()).strip() == "VERIFIED"
+
+async def process_ipn_batch() -> int:
+    rows = await db_pool.fetch(IPN_BACKLOG_SQL, IPN_BATCH_SIZE, IPN_LEASE_SECONDS)
+    if not rows:
+        return 0
+    checks = await asyncio.gather(*(verify_ipn(r['body']) for r in rows), return_exceptions=True)
+    ids, wids, uids, valid, retry = [], [], [], [], []
+    for r, ok in zip(rows, checks):
+        if isinstance(ok, Exception):
+            retry.append(r['id'])  # back off so it can't hold the head of the queue
+            continue
+        data = dict(parse_qsl(r['body']))
+        try:
+            uid = int(data.get('custom', 0))
+        except ValueError:
+            ok, uid = False, 0
+        ids.append(r['id'])
+        wids.append(data.get('invoice', ''))
+        uids.append(uid)
+        valid.append(ok)
+    if retry:
+        await db_pool.execute(IPN_RETRY_SQL, retry, IPN_POLL_SECONDS, IPN_MAX_BACKOFF, IPN_MAX_ATTEMPTS)
+    if ids:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(LOCK_WAGERS_SQL, sorted({w for w, ok in zip(wids, valid) if ok}))
+                claimed = [r['wager_id'] for r in await conn.fetch(CLAIM_IPN_SQL, ids, wids, uids, valid)]
+                funded = await conn.fetch(FUND_WAGERS_SQL, claimed)
+                late = [r['wager_id'] for r in await conn.fetch(FLAG_LATE_PAYMENTS_SQL, claimed)]
+        for r in funded:
+            await announce_funded(r['wager_id'])
+        if late:
+            announce_stale(late, late=True)
+    return len(rows)
+
+async def announce_funded(wid: str, relay: bool = True):
+    # Only the process whose shard sees the confirm channel can post; an
+    # IPN-only process hands the announcement to the gateway processes.
+    if bot.get_channel(CONFIRM_CHANNEL_ID):
+        dispatcher.post(CONFIRM_CHANNEL_ID, f"💵 Wager {wid} funded. Match on!")
+    elif relay:
+        publish("wager_funded", wager_id=wid)
+
+async def ipn_worker():
+    while True:
+        try:
+            await asyncio.wait_for(ipn_wakeup.wait(), IPN_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        ipn_wakeup.clear()
+        try:
+            with timed(TASK_SECONDS, "ipn_worker", task="ipn_worker"):
+                while await process_ipn_batch() == IPN_BATCH_SIZE:
+                    pass
+        except Exception as e:
+            print(f"❌ IPN worker: {e!r}")
+
+# ---------- Exports ----------
+EXPORT_FILTER = (
+    "($1::timestamptz IS NULL OR w.created_at >= $1) "
+    "AND ($2::timestamptz IS NULL OR w.created_at < $2) "
+    "AND ($3::text IS NULL OR w.status = $3)"
+)
+# Live and archived rows together; filters push down into both branches.
+ALL_WAGERS = (f"(SELECT {WAGER_COLUMNS} FROM wagers "
+              f"UNION ALL SELECT {WAGER_COLUMNS} FROM wagers_archive)")
+ALL_PAYMENTS = (f"(SELECT {PAYMENT_COLUMNS} FROM payments "
+                f"UNION ALL SELECT {PAYMENT_COLUMNS} FROM payments_archive)")
+EXPORT_QUERIES = [
+    ("wagers.csv", f"SELECT w.* FROM {ALL_WAGERS} w WHERE {EXPORT_FILTER} ORDER BY w.created_at", True),
+    ("payments.csv",
+     f"SELECT p.* FROM {ALL_PAYMENTS} p JOIN {ALL_WAGERS} w ON w.wager_id=p.wager_id "
+     f"WHERE {EXPORT_FILTER} ORDER BY w.created_at, p.user_id", True),
+    ("users.csv",
+     f"WITH tail AS ({LEDGER_TAIL_SQL}) "
+     "SELECT user_id, COALESCE(u.wins,0)+COALESCE(t.wins,0) AS wins, "
+     "COALESCE(u.losses,0)+COALESCE(t.losses,0) AS losses, COALESCE(u.coins,0)+COALESCE(t.coins,0) AS coins "
+     "FROM users u FULL JOIN tail t USING (user_id) ORDER BY user_id", False),
+    ("coin_ledger.csv",
+     "SELECT id,user_id,wager_id,wins,losses,coins,reason,created_at FROM coin_ledger ORDER BY id", False),
+]
+
+class _ZipSink:
+    # Write-only buffer for a streaming ZipFile; zipfile falls back to data
+    # descriptors because it can't seek, so bytes can be shipped as produced.
+    def __init__(self):
+        self._buf = bytearray()
+
+    def write(self, data) -> int:
+        self._buf += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def __len__(self):
+        return len(self._buf)
+
+    def take(self) -> bytes:
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+def parse_export_date(value: str):
+    if not value:
+        return None
+    d = datetime.fromisoformat(value)
+    return d if d.tzinfo else d.replace(tzinfo=timezone.utc)
+
+async def stream_export(write, since=None, until=None, status=None):
+    # COPY each table straight into its zip entry; `write` receives the
+    # archive in chunks, so memory stays flat however many rows match.
+    sink = _ZipSink()
+    async with db_pool.acquire() as conn:
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, query, filtered in EXPORT_QUERIES:
+                with zf.open(name, "w", force_zip64=True) as entry:
+                    async def output(chunk, entry=entry):
+                        entry.write(chunk)
+                        if len(sink) >= EXPORT_FLUSH_BYTES:
+                            await write(sink.take())
+                    args = (since, until, status) if filtered else ()
+                    await conn.copy_from_query(query, *args, output=output, format="csv", header=True)
+                await write(sink.take())
+    await write(sink.take())
+
+def export_filename(since, until, status) -> str:
+    parts = ["betbro-export"]
+    if since:
+        parts.append(f"from-{since:%Y%m%d}")
+    if until:
+        parts.append(f"to-{until:%Y%m%d}")
+    if status:
+        parts.append(status)
+    return "-".join(parts) + ".zip"
+
+async def handle_export(request):
+    if not EXPORT_TOKEN:
+        raise web.HTTPNotFound()
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {EXPORT_TOKEN}".encode()):
+        raise web.HTTPUnauthorized()
+    await db_ready.wait()
+    try:
+        since = parse_export_date(request.query.get("since"))
+        until = parse_export_date(request.query.get("until"))
+    except ValueError:
+        raise web.HTTPBadRequest(text="since/until must be ISO dates")
+    status = request.query.get("status") or None
+    resp = web.StreamResponse(headers={
+        "Content-Type": "application/zip",
+        "Content-Disposition": f'attachment; filename="{export_filename(since, until, status)}"',
+    })
+    await resp.prepare(request)
+    # A slow client holds its connection for the whole download, so exports
+    # get their own budget rather than starving the background jobs.
+    async with export_slots.slot():
+        await stream_export(resp.write, since, until, status)
+    await resp.write_eof()
+    return resp
+
+async def handle_metrics(request):
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
 app = web.Application()
 app.router.add_post('/paypal/ipn', handle_ipn)
+app.router.add_get('/metrics', handle_metrics)
+app.router.add_get('/export', handle_export)
+
+# ---------- Wager Resolution ----------
+# Resolves every (wager_id, winner_id) in the batch that names an open wager of
+# the requested kind and one of its players, and folds both players' stat
+# changes into a single upsert per user. $1 is the kind filter (NULL = any).
+RESOLVE_SQL = """
+WITH batch AS ({source}), resolved AS (
+    UPDATE wagers w SET status='resolved'
+    FROM batch b
+    WHERE w.wager_id=b.wager_id AND w.status IN ('pending','paid')
+      AND ($1::bool IS NULL OR w.is_supervised=$1)
+      AND b.winner_id IN (w.p1_id, w.p2_id)
+    RETURNING w.wager_id, w.amount_usd, w.commission, w.is_supervised, b.winner_id,
+              CASE WHEN w.p1_id=b.winner_id THEN w.p2_id ELSE w.p1_id END AS loser_id
+), ledger AS (
+    INSERT INTO coin_ledger(user_id,wager_id,wins,losses,coins,reason)
+    SELECT winner_id, wager_id, 1, 0, amount_usd, 'win' FROM resolved
+    UNION ALL
+    SELECT loser_id, wager_id, 0, 1, 0, 'loss' FROM resolved
+)
+SELECT * FROM resolved
+"""
+RESOLVE_FROM_ARRAYS = "SELECT * FROM unnest($2::text[], $3::bigint[]) AS b(wager_id, winner_id)"
+RESOLVE_FROM_TEMP = "SELECT wager_id, winner_id FROM resolve_batch"
+
+async def resolve_wagers(conn, results: list, supervised: bool = None) -> list:
+    # results: [(wager_id, winner_id)]. Small batches travel as arrays in one
+    # statement; big uploads are COPYed into a temp table first.
+    results = list(dict(results).items())
+    if len(results) > RESOLVE_COPY_THRESHOLD:
+        async with conn.transaction():
+            await conn.execute(
+                "CREATE TEMP TABLE resolve_batch (wager_id TEXT, winner_id BIGINT) ON COMMIT DROP"
+            )
+            await conn.copy_records_to_table("resolve_batch", records=results)
+            rows = await conn.fetch(RESOLVE_SQL.format(source=RESOLVE_FROM_TEMP), supervised)
+    else:
+        rows = await conn.fetch(
+            RESOLVE_SQL.format(source=RESOLVE_FROM_ARRAYS), supervised,
+            [wid for wid, _ in results], [uid for _, uid in results]
+        )
+    user_ids = list({uid for r in rows for uid in (r["winner_id"], r["loser_id"])})
+    invalidate_profiles(*user_ids)
+    if rows:
+        # New totals live in the ledger tail; let the next read recombine them
+        stats_board.invalidate()
+        publish_ids("resolved", "user_ids", user_ids)
+    return rows
+
+def resolution_embed(r, score: str) -> discord.Embed:
+    pot = float(r["amount_usd"]) * 2
+    commission = float(r["commission"]) if r["commission"] is not None else round(pot * COMMISSION_RATE, 2)
+    payout = round(pot - commission, 2)
+    if r["is_supervised"]:
+        embed = discord.Embed(title="🎯 Supervised Wager Resolved", color=discord.Color.green())
+    else:
+        embed = discord.Embed(title="📜 Wager Resolved", color=discord.Color.gold())
+    embed.add_field(name="Wager ID", value=r["wager_id"], inline=False)
+    embed.add_field(name="Winner", value=f"<@{r['winner_id']}>", inline=True)
+    embed.add_field(name="Score", value=score or "—", inline=True)
+    embed.add_field(name="Total Pot", value=f"${pot:.2f}", inline=False)
+    embed.add_field(name="Commission (5%)", value=f"${commission:.2f}", inline=False)
+    embed.add_field(name="Payout", value=f"${payout:.2f}", inline=False)
+    return embed
+
+def parse_results_csv(text: str) -> tuple:
+    # Rows of `wager_id,winner[,score]`; winner is a user ID or mention.
+    # Returns ({wager_id: (winner_id, score)}, [unparseable lines]).
+    parsed, bad = {}, []
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not "".join(row).strip() or row[0].strip().lower() == "wager_id":
+            continue
+        winner = re.sub(r"[<@!>\s]", "", row[1]) if len(row) > 1 else ""
+        if not winner.isdigit():
+            bad.append(",".join(row))
+            continue
+        score = row[2].strip() if len(row) > 2 else ""
+        parsed[row[0].strip()] = (int(winner), score)
+    return parsed, bad
 
 # ---------- Slash Commands & Views ----------
 class RiskConfirm(discord.ui.View):
@@ -171,70 +1680,86 @@ class RiskConfirm(discord.ui.View):
     async def accept(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.pid:
             return await interaction.response.send_message("Not for you.", ephemeral=True)
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                'UPDATE payments SET paid=TRUE WHERE wager_id=$1 AND user_id=$2',
-                self.wid, self.pid
-            )
-        await interaction.response.send_message("Accepted. Use /confirmwager.", ephemeral=True)
+        # Same rules as an instrumented command: acknowledge first, then wait
+        # for a slot in the ordinary command budget before touching the pool.
+        try:
+            with timed(COMMAND_SECONDS, "accept", command="accept"):
+                try:
+                    await interaction.response.defer(ephemeral=True)
+                except discord.NotFound:
+                    return
+                try:
+                    async with command_slots.slot():
+                        await db_ready.wait()
+                        async with db_pool.acquire() as conn:
+                            async with conn.transaction():
+                                await conn.execute(LOCK_WAGERS_SQL, [self.wid])
+                                await conn.execute(
+                                    'UPDATE payments SET paid=TRUE WHERE wager_id=$1 AND user_id=$2',
+                                    self.wid, self.pid
+                                )
+                except CommandBusy as e:
+                    COMMANDS_SHED.inc(command="accept", reason=str(e))
+                    return await reply_error(interaction, "⏳ The bot is busy, try again shortly.")
+        except Exception:
+            print("❌ Command accept failed:")
+            traceback.print_exc()
+            return await reply_error(interaction, "❌ Failed to accept wager.")
+        await interaction.followup.send("Accepted. Use /confirmwager.", ephemeral=True)
 
 @bot.tree.command(name="wager", description="Start a risk wager.")
 @app_commands.describe(opponent="Opponent", amount="USD amount", link="Game link")
+@instrumented("wager", "❌ Failed to create wager.")
 async def wager_cmd(
     interaction: discord.Interaction,
     opponent: discord.Member,
     amount: float,
     link: str
 ):
-    try:
-        wid = generate_wager_id()
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO wagers(wager_id,host_id,p1_id,p2_id,amount_usd,is_supervised,status) '
-                'VALUES($1,$2,$3,$4,$5,$6,$7)',
-                wid, interaction.user.id, interaction.user.id, opponent.id,
-                amount, False, 'pending'
-            )
-            await conn.executemany(
-                'INSERT INTO payments(wager_id,user_id) VALUES($1,$2)',
-                [(wid, interaction.user.id), (wid, opponent.id)]
-            )
-        embed = discord.Embed(title="Risk Wager Invite", color=discord.Color.blurple())
-        embed.add_field(name="Wager ID", value=wid)
-        embed.add_field(name="Challenger", value=interaction.user.mention)
-        embed.add_field(name="Opponent", value=opponent.mention)
-        embed.add_field(name="Amount (USD)", value=f"${amount:.2f}")
-        embed.add_field(name="Game Link", value=link)
-        await interaction.response.send_message("Invite sent! Awaiting confirmation.", ephemeral=True)
-        view = RiskConfirm(wid, opponent.id)
-        await opponent.send(embed=embed, view=view)
-    except Exception:
-        await interaction.response.send_message("❌ Failed to create wager.", ephemeral=True)
+    wid = generate_wager_id()
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            'INSERT INTO wagers(wager_id,host_id,p1_id,p2_id,amount_usd,is_supervised,status) '
+            'VALUES($1,$2,$3,$4,$5,$6,$7)',
+            wid, interaction.user.id, interaction.user.id, opponent.id,
+            amount, False, 'pending'
+        )
+        await conn.executemany(
+            'INSERT INTO payments(wager_id,user_id) VALUES($1,$2)',
+            [(wid, interaction.user.id), (wid, opponent.id)]
+        )
+    embed = discord.Embed(title="Risk Wager Invite", color=discord.Color.blurple())
+    embed.add_field(name="Wager ID", value=wid)
+    embed.add_field(name="Challenger", value=interaction.user.mention)
+    embed.add_field(name="Opponent", value=opponent.mention)
+    embed.add_field(name="Amount (USD)", value=f"${amount:.2f}")
+    embed.add_field(name="Game Link", value=link)
+    await interaction.followup.send("Invite sent! Awaiting confirmation.", ephemeral=True)
+    view = RiskConfirm(wid, opponent.id)
+    await opponent.send(embed=embed, view=view)
 
 @bot.tree.command(name="confirmwager", description="Confirm risk wager funding.")
+@instrumented("confirmwager", "❌ Error confirming wager.", priority="high")
 async def confirmwager(
     interaction: discord.Interaction,
     wager_id: str
 ):
-    try:
-        async with db_pool.acquire() as conn:
-            cnt = await conn.fetchval(
-                'SELECT COUNT(*) FROM payments WHERE wager_id=$1 AND paid=TRUE',
-                wager_id
-            )
-            if cnt == 2:
-                await conn.execute(
-                    'UPDATE wagers SET status="paid" WHERE wager_id=$1',
-                    wager_id
-                )
-                c = bot.get_channel(CONFIRM_CHANNEL_ID)
-                if c:
-                    await c.send(f"💵 Risk wager {wager_id} funded!")
-                await interaction.response.send_message("Confirmed!", ephemeral=True)
-            else:
-                await interaction.response.send_message("Waiting on payments.", ephemeral=True)
-    except Exception:
-        await interaction.response.send_message("❌ Error confirming wager.", ephemeral=True)
+    # Same lock-and-fund path as confirm_payment: only a pending wager with
+    # every payment in moves to paid, so a resolved wager can't be reopened.
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(LOCK_WAGERS_SQL, [wager_id])
+            funded = await conn.fetch(FUND_WAGERS_SQL, [wager_id])
+            status = await conn.fetchval("SELECT status FROM wagers WHERE wager_id=$1", wager_id)
+    if funded:
+        dispatcher.post(CONFIRM_CHANNEL_ID, f"💵 Risk wager {wager_id} funded!")
+        await interaction.followup.send("Confirmed!", ephemeral=True)
+    elif status is None:
+        await interaction.followup.send("Invalid risk wager ID.", ephemeral=True)
+    elif status == "pending":
+        await interaction.followup.send("Waiting on payments.", ephemeral=True)
+    else:
+        await interaction.followup.send(f"Wager is already {status}.", ephemeral=True)
 
 @bot.tree.command(name="wagermod",
                   description="Create a supervised wager (mod only) with a single PayPal link.")
@@ -243,225 +1768,515 @@ async def confirmwager(
     player1="First player", player2="Second player", amount="USD amount",
     vod="VOD required? (yes/no)", paypal_link="PayPal link for both players"
 )
+@instrumented("wagermod", "❌ Failed to create supervised wager.")
 async def wagermod(interaction: discord.Interaction,
                    player1: discord.Member, player2: discord.Member,
                    amount: float, vod: str, paypal_link: str):
-    try:
-        wid = generate_wager_id()
-        vod_req = vod.lower() == "yes"
-        total_pot = amount * 2
-        commission = round(total_pot * COMMISSION_RATE, 2)
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO wagers(wager_id,host_id,p1_id,p2_id,amount_usd,is_supervised,"
-                "vod_required,mod_id,status,paypal_link_p1,commission) "
-                "VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11)",
-                wid, interaction.user.id, player1.id, player2.id,
-                amount, True, vod_req, interaction.user.id, "pending", paypal_link, commission
-            )
-            await conn.executemany(
-                "INSERT INTO payments(wager_id,user_id) VALUES($1,$2)",
-                [(wid, player1.id), (wid, player2.id)]
-            )
-        embed = discord.Embed(title="🕵️ Supervised Wager Created", color=discord.Color.orange())
-        embed.add_field(name="Wager ID", value=wid, inline=False)
-        embed.add_field(name="Amount (each)", value=f"${amount:.2f}", inline=True)
-        embed.add_field(name="Total Pot", value=f"${total_pot:.2f}", inline=True)
-        embed.add_field(name="Commission (5%)", value=f"${commission:.2f}", inline=True)
-        embed.add_field(name="VOD Required", value="Yes" if vod_req else "No", inline=False)
-        embed.add_field(name="PayPal Link", value=paypal_link, inline=False)
-        embed.set_footer(text="Moderator must confirm payments to start match.")
-        await interaction.response.send_message("Wager created and posted.", ephemeral=True)
-        ch = bot.get_channel(CONFIRM_CHANNEL_ID)
-        if ch:
-            await ch.send(embed=embed)
-    except Exception:
-        await interaction.response.send_message("❌ Failed to create supervised wager.", ephemeral=True)
+    wid = generate_wager_id()
+    vod_req = vod.lower() == "yes"
+    total_pot = amount * 2
+    commission = round(total_pot * COMMISSION_RATE, 2)
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO wagers(wager_id,host_id,p1_id,p2_id,amount_usd,is_supervised,"
+            "vod_required,mod_id,status,paypal_link_p1,commission) "
+            "VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11)",
+            wid, interaction.user.id, player1.id, player2.id,
+            amount, True, vod_req, interaction.user.id, "pending", paypal_link, commission
+        )
+        await conn.executemany(
+            "INSERT INTO payments(wager_id,user_id) VALUES($1,$2)",
+            [(wid, player1.id), (wid, player2.id)]
+        )
+    embed = discord.Embed(title="🕵️ Supervised Wager Created", color=discord.Color.orange())
+    embed.add_field(name="Wager ID", value=wid, inline=False)
+    embed.add_field(name="Amount (each)", value=f"${amount:.2f}", inline=True)
+    embed.add_field(name="Total Pot", value=f"${total_pot:.2f}", inline=True)
+    embed.add_field(name="Commission (5%)", value=f"${commission:.2f}", inline=True)
+    embed.add_field(name="VOD Required", value="Yes" if vod_req else "No", inline=False)
+    embed.add_field(name="PayPal Link", value=paypal_link, inline=False)
+    embed.set_footer(text="Moderator must confirm payments to start match.")
+    await interaction.followup.send("Wager created and posted.", ephemeral=True)
+    dispatcher.post(CONFIRM_CHANNEL_ID, embed=embed)
+
+async def confirm_payment(wid: str, user_id: int) -> tuple:
+    # Marks one payment and funds the wager once nothing is left unpaid.
+    # Returns (funded, late): funded only for the call that funded it, late if
+    # the wager had already expired. The wager lock orders this against other
+    # confirmations, IPN batches and the sweeper, and the funding check runs
+    # in a fresh snapshot that sees their committed payments.
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(LOCK_WAGERS_SQL, [wid])
+            await conn.execute("UPDATE payments SET paid=TRUE WHERE wager_id=$1 AND user_id=$2", wid, user_id)
+            funded = bool(await conn.fetch(FUND_WAGERS_SQL, [wid]))
+            late = bool(await conn.fetch(FLAG_LATE_PAYMENTS_SQL, [wid]))
+    return funded, late
 
 @bot.tree.command(name="confirmpayment", description="Confirm a player's PayPal payment.")
 @app_commands.checks.has_permissions(manage_guild=True)
+@instrumented("confirmpayment", "❌ Error confirming payment.", priority="high")
 async def confirmpayment(interaction: discord.Interaction,
                          wid: str, player: discord.Member):
-    try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE payments SET paid=TRUE WHERE wager_id=$1 AND user_id=$2", wid, player.id
-            )
-            cnt = await conn.fetchval(
-                "SELECT COUNT(*) FROM payments WHERE wager_id=$1 AND paid=TRUE", wid
-            )
-            if cnt == 2:
-                await conn.execute("UPDATE wagers SET status='paid' WHERE wager_id=$1", wid)
-                c = bot.get_channel(CONFIRM_CHANNEL_ID)
-                if c:
-                    await c.send(f"💵 Wager {wid} funded!")
-        await interaction.response.send_message(f"{player.mention} confirmed.", ephemeral=True)
-    except Exception:
-        await interaction.response.send_message("❌ Error confirming payment.", ephemeral=True)
+    funded, late = await confirm_payment(wid, player.id)
+    if funded:
+        dispatcher.post(CONFIRM_CHANNEL_ID, f"💵 Wager {wid} funded!")
+    if late:
+        announce_stale([wid], late=True)
+        return await interaction.followup.send(
+            f"{player.mention} confirmed, but wager {wid} has already expired. "
+            "Flagged for mod review.", ephemeral=True
+        )
+    await interaction.followup.send(f"{player.mention} confirmed.", ephemeral=True)
 
 @bot.tree.command(name="resolve", description="Resolve an unsupervised wager.")
 @app_commands.describe(wid="Wager ID", winner="Winner", score="Score")
+@instrumented("resolve", "❌ Error resolving wager.")
 async def resolve(interaction: discord.Interaction,
                   wid: str, winner: discord.Member, score: str):
-    try:
-        async with db_pool.acquire() as conn:
-            d = await conn.fetchrow("SELECT * FROM wagers WHERE wager_id=$1", wid)
-            if not d or d["is_supervised"]:
-                return await interaction.response.send_message(
-                    "Invalid risk wager ID.", ephemeral=True
-                )
-            await conn.execute("UPDATE wagers SET status='resolved' WHERE wager_id=$1", wid)
-            pot = d["amount_usd"] * 2
-            commission = d.get("commission", round(pot * COMMISSION_RATE, 2))
-            payout = round(pot - commission, 2)
-            # update stats
-            await conn.execute(
-                "UPDATE users SET wins=wins+1, coins=coins+$1 WHERE user_id=$2",
-                d["amount_usd"], winner.id
-            )
-            loser = d["p1_id"] if d["p2_id"] == winner.id else d["p2_id"]
-            await conn.execute("UPDATE users SET losses=losses+1 WHERE user_id=$1", loser)
-        embed = discord.Embed(title="📜 Wager Resolved", color=discord.Color.gold())
-        embed.add_field(name="Wager ID", value=wid, inline=False)
-        embed.add_field(name="Winner", value=winner.mention, inline=True)
-        embed.add_field(name="Score", value=score, inline=True)
-        embed.add_field(name="Total Pot", value=f"${pot:.2f}", inline=False)
-        embed.add_field(name="Commission (5%)", value=f"${commission:.2f}", inline=False)
-        embed.add_field(name="Payout", value=f"${payout:.2f}", inline=False)
-        lc = bot.get_channel(LOG_CHANNEL_ID)
-        if lc:
-            await lc.send(embed=embed)
-        await interaction.response.send_message("Resolved and payout shown.", ephemeral=True)
-    except Exception:
-        await interaction.response.send_message("❌ Error resolving wager.", ephemeral=True)
+    async with db_pool.acquire() as conn:
+        rows = await resolve_wagers(conn, [(wid, winner.id)], supervised=False)
+    if not rows:
+        return await interaction.followup.send(
+            "Invalid risk wager ID.", ephemeral=True
+        )
+    dispatcher.post(LOG_CHANNEL_ID, embed=resolution_embed(rows[0], score))
+    await interaction.followup.send("Resolved and payout shown.", ephemeral=True)
 
 @bot.tree.command(name="resolvemod", description="Resolve a supervised wager.")
 @app_commands.checks.has_permissions(manage_guild=True)
 @app_commands.describe(wid="Wager ID", winner="Winner", score="Score")
+@instrumented("resolvemod", "❌ Error resolving mod wager.")
 async def resolvemod(interaction: discord.Interaction,
                      wid: str, winner: discord.Member, score: str):
-    try:
-        async with db_pool.acquire() as conn:
-            d = await conn.fetchrow("SELECT * FROM wagers WHERE wager_id=$1", wid)
-            if not d or not d["is_supervised"]:
-                return await interaction.response.send_message(
-                    "Invalid supervised wager ID.", ephemeral=True
-                )
-            await conn.execute("UPDATE wagers SET status='resolved' WHERE wager_id=$1", wid)
-            pot = d["amount_usd"] * 2
-            commission = d.get("commission", round(pot * COMMISSION_RATE, 2))
-            payout = round(pot - commission, 2)
-            # update stats
-            await conn.execute(
-                "UPDATE users SET wins=wins+1, coins=coins+$1 WHERE user_id=$2",
-                d["amount_usd"], winner.id
-            )
-            loser = d["p1_id"] if d["p2_id"] == winner.id else d["p2_id"]
-            await conn.execute("UPDATE users SET losses=losses+1 WHERE user_id=$1", loser)
-        embed = discord.Embed(title="🎯 Supervised Wager Resolved", color=discord.Color.green())
-        embed.add_field(name="Wager ID", value=wid, inline=False)
-        embed.add_field(name="Winner", value=winner.mention, inline=True)
-        embed.add_field(name="Score", value=score, inline=True)
-        embed.add_field(name="Total Pot", value=f"${pot:.2f}", inline=False)
-        embed.add_field(name="Commission (5%)", value=f"${commission:.2f}", inline=False)
-        embed.add_field(name="Payout", value=f"${payout:.2f}", inline=False)
-        mch = bot.get_channel(MOD_RESULTS_CHANNEL_ID)
-        if mch:
-            await mch.send(embed=embed)
-        await interaction.response.send_message("Mod resolved and payout shown.", ephemeral=True)
-    except Exception:
-        await interaction.response.send_message("❌ Error resolving mod wager.", ephemeral=True)
+    async with db_pool.acquire() as conn:
+        rows = await resolve_wagers(conn, [(wid, winner.id)], supervised=True)
+    if not rows:
+        return await interaction.followup.send(
+            "Invalid supervised wager ID.", ephemeral=True
+        )
+    dispatcher.post(MOD_RESULTS_CHANNEL_ID, embed=resolution_embed(rows[0], score))
+    await interaction.followup.send("Mod resolved and payout shown.", ephemeral=True)
+
+@bot.tree.command(name="resolvebatch",
+                  description="Resolve many wagers from a CSV of wager_id,winner[,score] (mod only).")
+@app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.describe(results="CSV file: wager_id,winner_id[,score] per line")
+@instrumented("resolvebatch", "❌ Error resolving batch.", limit=1)
+async def resolvebatch(interaction: discord.Interaction, results: discord.Attachment):
+    parsed, bad = parse_results_csv((await results.read()).decode("utf-8-sig"))
+    async with db_pool.acquire() as conn:
+        rows = await resolve_wagers(
+            conn, [(wid, uid) for wid, (uid, _) in parsed.items()]
+        )
+    for r in rows:
+        ch_id = MOD_RESULTS_CHANNEL_ID if r["is_supervised"] else LOG_CHANNEL_ID
+        dispatcher.post(ch_id, embed=resolution_embed(r, parsed[r["wager_id"]][1]))
+    done = {r["wager_id"] for r in rows}
+    skipped = [wid for wid in parsed if wid not in done] + bad
+    msg = f"Resolved {len(rows)} of {len(parsed) + len(bad)} wagers."
+    if skipped:
+        msg += "\nSkipped: " + ", ".join(skipped[:20]) + (" …" if len(skipped) > 20 else "")
+    await interaction.followup.send(msg, ephemeral=True)
 
 @bot.tree.command(name="dispute", description="Flag a wager for review.")
+@instrumented("dispute", "❌ Error flagging dispute.", priority="high")
 async def dispute(interaction: discord.Interaction, wid: str):
-    try:
-        mch = bot.get_channel(MOD_RESULTS_CHANNEL_ID)
-        if mch:
-            await mch.send(f"⚠️ Dispute opened for {wid} by {interaction.user.mention}")
-        await interaction.response.send_message("Dispute flagged.", ephemeral=True)
-    except Exception:
-        await interaction.response.send_message("❌ Error flagging dispute.", ephemeral=True)
+    dispatcher.post(MOD_RESULTS_CHANNEL_ID, f"⚠️ Dispute opened for {wid} by {interaction.user.mention}")
+    await interaction.followup.send("Dispute flagged.", ephemeral=True)
 
 @bot.tree.command(name="profile", description="View a user's profile.")
 @app_commands.describe(user="Optional user")
+@instrumented("profile", "❌ Error fetching profile.", priority="low", ephemeral=False)
 async def profile(interaction: discord.Interaction, user: discord.User = None):
-    try:
-        u = user or interaction.user
-        async with db_pool.acquire() as conn:
-            st = await conn.fetchrow(
-                "SELECT wins,losses,coins,stats_rank FROM users WHERE user_id=$1", u.id
-            )
-            rt = await conn.fetchrow(
-                "SELECT rank,tier FROM user_ranks WHERE user_id=$1", u.id
-            )
-        embed = discord.Embed(title=f"{u.display_name}'s Profile", color=discord.Color.blue())
-        embed.set_thumbnail(url=u.display_avatar.url)
-        embed.add_field(name="Role Rank", value=f"{rt['rank']} {rt['tier'].capitalize()}", inline=True)
-        embed.add_field(name="Stats Rank", value=st['stats_rank'], inline=True)
-        embed.add_field(name="Wins", value=str(st['wins']), inline=True)
-        embed.add_field(name="Losses", value=str(st['losses']), inline=True)
-        embed.add_field(name="Coins", value=f"${st['coins']:.2f}", inline=True)
-        await interaction.response.send_message(embed=embed)
-    except Exception:
-        await interaction.response.send_message("❌ Error fetching profile.", ephemeral=True)
+    u = user or interaction.user
+    p = await get_profile(u.id)
+    embed = discord.Embed(title=f"{u.display_name}'s Profile", color=discord.Color.blue())
+    embed.set_thumbnail(url=u.display_avatar.url)
+    embed.add_field(name="Role Rank", value=f"{p['rank']} {p['tier'].capitalize()}", inline=True)
+    embed.add_field(name="Stats Rank", value=p['stats_rank'], inline=True)
+    embed.add_field(name="Wins", value=str(p['wins']), inline=True)
+    embed.add_field(name="Losses", value=str(p['losses']), inline=True)
+    embed.add_field(name="Coins", value=f"${p['coins']:.2f}", inline=True)
+    await interaction.followup.send(embed=embed)
 
 @bot.tree.command(name="leaderboard", description="Show role or stats leaderboard.")
 @app_commands.describe(type="'role' or 'stats'")
+@instrumented("leaderboard", "❌ Error posting leaderboard.", limit=2, priority="low")
 async def leaderboard(interaction: discord.Interaction, type: str):
+    t = type.lower()
+    embed = discord.Embed(color=discord.Color.gold())
+    if t == "role":
+        embed.title = "🏅 Role Leaderboard"
+        rows = await role_board.top()
+        names = await get_display_names(r["user_id"] for r in rows)
+        for i, r in enumerate(rows, 1):
+            embed.add_field(name=f"{i}. {names[r['user_id']]}",
+                            value=f"{r['rank']} {r['tier'].capitalize()}",
+                            inline=False)
+    elif t == "stats":
+        embed.title = "🏆 Stats Leaderboard"
+        rows = await stats_board.top()
+        names = await get_display_names(r["user_id"] for r in rows)
+        for i, r in enumerate(rows, 1):
+            embed.add_field(name=f"{i}. {names[r['user_id']]}",
+                            value=f"${r['coins']:.2f}, {r['wins']} wins ({get_stats_rank(r['wins'], r['coins'])})",
+                            inline=False)
+    else:
+        return await interaction.followup.send("❌ Invalid type.", ephemeral=True)
+    dispatcher.post(LEADERBOARD_CHANNEL_ID, embed=embed)
+    await interaction.followup.send(f"{type.capitalize()} leaderboard posted.", ephemeral=True)
+
+@bot.tree.command(name="export", description="Export wagers, payments and users as zipped CSV (mod only).")
+@app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.describe(since="From date (YYYY-MM-DD)", until="Until date, exclusive (YYYY-MM-DD)",
+                       status="Only wagers with this status")
+@instrumented("export", "❌ Error exporting data.", limit=1, priority="low")
+async def export(interaction: discord.Interaction,
+                 since: str = None, until: str = None, status: str = None):
     try:
-        t = type.lower()
-        embed = discord.Embed(color=discord.Color.gold())
-        async with db_pool.acquire() as conn:
-            if t == "role":
-                embed.title = "🏅 Role Leaderboard"
-                rows = await conn.fetch(
-                    "SELECT user_id,rank,tier FROM user_ranks "
-                    "ORDER BY (CASE rank WHEN 'N/A' THEN 0 ELSE CAST(SUBSTRING(rank,2) AS INT) END) DESC, "
-                    "(CASE tier WHEN 'none' THEN 0 WHEN 'low' THEN 1 WHEN 'mid' THEN 2 ELSE 3 END) DESC "
-                    "LIMIT 5"
-                )
-                for i, r in enumerate(rows, 1):
-                    u = await bot.fetch_user(r["user_id"])
-                    embed.add_field(name=f"{i}. {u.display_name}",
-                                    value=f"{r['rank']} {r['tier'].capitalize()}",
-                                    inline=False)
-            elif t == "stats":
-                embed.title = "🏆 Stats Leaderboard"
-                rows = await conn.fetch(
-                    "SELECT user_id,coins,wins,stats_rank FROM users ORDER BY coins DESC LIMIT 10"
-                )
-                for i, r in enumerate(rows, 1):
-                    u = await bot.fetch_user(r["user_id"])
-                    embed.add_field(name=f"{i}. {u.display_name}",
-                                    value=f"${r['coins']:.2f}, {r['wins']} wins ({r['stats_rank']})",
-                                    inline=False)
-            else:
-                return await interaction.response.send_message("❌ Invalid type.", ephemeral=True)
-        await bot.get_channel(LEADERBOARD_CHANNEL_ID).send(embed=embed)
-        await interaction.response.send_message(f"{type.capitalize()} leaderboard posted.", ephemeral=True)
-    except Exception:
-        await interaction.response.send_message("❌ Error posting leaderboard.", ephemeral=True)
+        since_d, until_d = parse_export_date(since), parse_export_date(until)
+    except ValueError:
+        return await interaction.followup.send("❌ Dates must be YYYY-MM-DD.", ephemeral=True)
+    with tempfile.TemporaryFile() as fp:
+        async def write(data):
+            fp.write(data)
+        await stream_export(write, since_d, until_d, status)
+        size = fp.tell()
+        limit = interaction.guild.filesize_limit if interaction.guild else 25 * 1024 * 1024
+        if size > limit:
+            return await interaction.followup.send(
+                f"Export is {size / 1048576:.1f} MB, over the upload limit; use the /export HTTP endpoint.",
+                ephemeral=True
+            )
+        fp.seek(0)
+        await interaction.followup.send(
+            file=discord.File(fp, filename=export_filename(since_d, until_d, status)), ephemeral=True
+        )
+
+COMMAND_TREE_KEY = f"command_tree:{GUILD_ID}"
+
+def command_tree_hash(guild: discord.abc.Snowflake) -> str:
+    # Hashes exactly the payloads tree.sync(guild=...) sends: names,
+    # descriptions, options, permissions and all.
+    payload = [c.to_dict(bot.tree) for c in bot.tree.get_commands(guild=guild)]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    # A tree sync is a rate-limited round trip that is nearly always a no-op;
+    # only push when the tree differs from what we last synced.
+    guild = discord.Object(id=GUILD_ID)
+    # Commands are registered globally; syncing them as guild commands makes
+    # changes show up immediately in our one guild.
+    bot.tree.copy_global_to(guild=guild)
+    digest = command_tree_hash(guild)
+    await db_ready.wait()
+    async with job_slots.slot():
+        if await get_state(COMMAND_TREE_KEY) == digest:
+            return
+    await bot.tree.sync(guild=guild)
+    async with job_slots.slot():
+        await set_state(COMMAND_TREE_KEY, digest)
+    print("🔁 Command tree changed; synced")
+
+@bot.event
+async def setup_hook():
+    # Runs once per login, before the gateway connects; reconnects don't repeat it.
+    spawn(sync_commands())
+
+ready_after = None
+
+@bot.event
+async def on_disconnect():
+    mark_rank_logs_stale()
+
+@bot.event
+async def on_resumed():
+    mark_rank_logs_stale()
+    spawn(catch_up_rank_logs())
 
 @bot.event
 async def on_ready():
-    # Sync commands once ready
-    await bot.tree.sync(guild=discord.Object(id=GUILD_ID))
+    global ready_after
+    # Fires again after a fresh IDENTIFY, so pick up whatever was missed meanwhile
+    mark_rank_logs_stale()
+    spawn(catch_up_rank_logs())
+    if ready_after is None:
+        # Compare these figures across LOW_MEMORY=0/1 runs on the same guild
+        ready_after = time.monotonic() - STARTED_AT
+        READY_SECONDS.set(ready_after)
+        print(f"📈 Ready after {ready_after:.1f}s, RSS {current_rss_bytes() / 1048576:.0f} MB "
+              f"({'low-memory' if LOW_MEMORY else 'full'} gateway mode)")
     print(f"✅ Logged in as {bot.user}")
 
 
+# ---------- Schema ----------
+# (version, description, sql). Append only; applied versions are never re-run.
+# Indexes on live tables are given as a list of (name, definition) instead of
+# SQL: they are built with CREATE INDEX CONCURRENTLY outside a transaction, so
+# writers aren't blocked while they build. A (name, table, columns) entry in
+# such a list is a unique key the SQL depends on; see ensure_unique_key.
+MIGRATIONS = [
+    (1, "base tables", """
+CREATE TABLE IF NOT EXISTS wagers (
+    wager_id TEXT PRIMARY KEY,
+    host_id BIGINT NOT NULL,
+    p1_id BIGINT NOT NULL,
+    p2_id BIGINT NOT NULL,
+    amount_usd NUMERIC(12,2) NOT NULL,
+    is_supervised BOOLEAN NOT NULL DEFAULT FALSE,
+    vod_required BOOLEAN NOT NULL DEFAULT FALSE,
+    mod_id BIGINT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    paypal_link_p1 TEXT,
+    commission NUMERIC(12,2)
+);
+CREATE TABLE IF NOT EXISTS payments (
+    wager_id TEXT NOT NULL REFERENCES wagers(wager_id),
+    user_id BIGINT NOT NULL,
+    paid BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (wager_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    wins INT NOT NULL DEFAULT 0,
+    losses INT NOT NULL DEFAULT 0,
+    coins NUMERIC(12,2) NOT NULL DEFAULT 0,
+    stats_rank TEXT NOT NULL DEFAULT 'Rookie'
+);
+CREATE TABLE IF NOT EXISTS user_ranks (
+    user_id BIGINT PRIMARY KEY,
+    rank TEXT NOT NULL DEFAULT 'N/A',
+    tier TEXT NOT NULL DEFAULT 'none'
+);
+CREATE TABLE IF NOT EXISTS ipn_events (
+    id BIGSERIAL PRIMARY KEY,
+    txn_id TEXT NOT NULL UNIQUE,
+    body TEXT NOT NULL,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    processed_at TIMESTAMPTZ,
+    outcome TEXT
+);
+CREATE INDEX IF NOT EXISTS ipn_events_unprocessed ON ipn_events (id) WHERE processed_at IS NULL;
+"""),
+    (2, "indexes for hot query shapes", [
+        ("payments_paid_by_wager", "ON payments (wager_id) WHERE paid"),
+        ("payments_unpaid_by_wager", "ON payments (wager_id) WHERE NOT paid"),
+        ("wagers_pending", "ON wagers (wager_id) WHERE status = 'pending'"),
+        ("users_by_coins", "ON users (coins DESC)"),
+        ("user_ranks_role_order", f"ON user_ranks ({ROLE_RANK_EXPR}, {ROLE_TIER_EXPR})"),
+    ]),
+    (3, "wager creation time for exports", """
+ALTER TABLE wagers ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+"""),
+    (4, "wager creation time index", [
+        ("wagers_by_created_at", "ON wagers (created_at)"),
+    ]),
+    (5, "wager archive", """
+CREATE TABLE IF NOT EXISTS wagers_archive (LIKE wagers INCLUDING DEFAULTS);
+ALTER TABLE wagers_archive ADD PRIMARY KEY (wager_id);
+CREATE INDEX IF NOT EXISTS wagers_archive_by_created_at ON wagers_archive (created_at);
+CREATE TABLE IF NOT EXISTS payments_archive (LIKE payments INCLUDING DEFAULTS);
+ALTER TABLE payments_archive ADD PRIMARY KEY (wager_id, user_id);
+"""),
+    (6, "sweeper indexes", [
+        ("wagers_pending_by_age", "ON wagers (created_at) WHERE status = 'pending'"),
+        ("wagers_closed_by_age", "ON wagers (created_at) WHERE status IN ('resolved','expired')"),
+    ]),
+    (7, "bot state", """
+CREATE TABLE IF NOT EXISTS bot_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""),
+    (8, "append-only coin ledger", """
+CREATE TABLE IF NOT EXISTS coin_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    wager_id TEXT NOT NULL,
+    wins INT NOT NULL DEFAULT 0,
+    losses INT NOT NULL DEFAULT 0,
+    coins NUMERIC(12,2) NOT NULL DEFAULT 0,
+    reason TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    compacted BOOLEAN NOT NULL DEFAULT FALSE
+);
+"""),
+    (9, "coin ledger indexes", [
+        ("coin_ledger_by_user", "ON coin_ledger (user_id, id)"),
+        ("coin_ledger_tail", "ON coin_ledger (id) INCLUDE (user_id) WHERE NOT compacted"),
+        ("coin_ledger_tail_by_user", "ON coin_ledger (user_id) WHERE NOT compacted"),
+    ]),
+    (10, "IPN retry backoff", """
+ALTER TABLE ipn_events ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+ALTER TABLE ipn_events ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now();
+"""),
+    (11, "stale wager review flag", """
+ALTER TABLE wagers ADD COLUMN IF NOT EXISTS flagged_at TIMESTAMPTZ;
+"""),
+    # Tables that predate migration 1 were left as they were, so nothing yet
+    # guarantees the keys behind ON CONFLICT targets and the wager/payment lookups.
+    (12, "unique keys for pre-existing tables", [
+        ("wagers_wager_id_key", "wagers", ["wager_id"]),
+        ("payments_wager_id_user_id_key", "payments", ["wager_id", "user_id"]),
+        ("users_user_id_key", "users", ["user_id"]),
+        ("user_ranks_user_id_key", "user_ranks", ["user_id"]),
+        ("ipn_events_txn_id_key", "ipn_events", ["txn_id"]),
+    ]),
+]
+MIGRATION_LOCK_ID = 0x62657462  # pg advisory lock key; one migrator at a time
+
+async def build_index(conn, name: str, definition: str, unique: bool = False):
+    # A failed concurrent build leaves an INVALID index behind that IF NOT
+    # EXISTS would skip; drop it and start over.
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name
+    )
+    if invalid:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    await conn.execute(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} {definition}")
+
+# Any valid, non-partial unique index (a primary key included) whose key
+# columns are exactly $2 in any order; ON CONFLICT can infer from any of them.
+UNIQUE_KEY_EXISTS_SQL = """
+SELECT EXISTS (
+    SELECT 1 FROM pg_index i
+    WHERE i.indrelid = $1::regclass AND i.indisunique AND i.indisvalid
+      AND i.indpred IS NULL AND i.indexprs IS NULL AND i.indnatts = i.indnkeyatts
+      AND (SELECT array_agg(a.attname::text ORDER BY a.attname::text) FROM pg_attribute a
+           WHERE a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)) = $2::text[]
+)
+"""
+
+async def ensure_unique_key(conn, name: str, table: str, columns: list):
+    # Keep whatever key the table already has; otherwise build one. Duplicate
+    # rows make the build fail, and with it startup, rather than letting an
+    # upsert fail later.
+    if await conn.fetchval(UNIQUE_KEY_EXISTS_SQL, table, sorted(columns)):
+        return
+    try:
+        await build_index(conn, name, f"ON {table} ({', '.join(columns)})", unique=True)
+    except asyncpg.UniqueViolationError as e:
+        raise SystemExit(f"{table} has duplicate ({', '.join(columns)}) rows; "
+                         f"remove them before starting: {e}")
+
+async def migrate():
+    async with db_pool.acquire() as conn:
+        # Poll rather than block: a concurrent index build waits for every open
+        # snapshot, including a session stuck in pg_advisory_lock.
+        while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+            await asyncio.sleep(1)
+        try:
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INT PRIMARY KEY, description TEXT NOT NULL, "
+                "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+            applied = {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, description, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                if isinstance(sql, list):
+                    for name, *spec in sql:
+                        if len(spec) == 2:
+                            await ensure_unique_key(conn, name, *spec)
+                        else:
+                            await build_index(conn, name, *spec)
+                    # Recorded only once every build has succeeded
+                    await conn.execute(
+                        "INSERT INTO schema_migrations(version,description) VALUES($1,$2)",
+                        version, description
+                    )
+                else:
+                    async with conn.transaction():
+                        await conn.execute(sql)
+                        await conn.execute(
+                            "INSERT INTO schema_migrations(version,description) VALUES($1,$2)",
+                            version, description
+                        )
+                print(f"🗄️ Applied migration {version}: {description}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+# Hot-path queries that must be servable from an index: (name, sql, sample args)
+CHECKED_QUERIES = [
+    ("fund wagers", FUND_WAGERS_SQL, (["WGR-000000"],)),
+    ("flag late payments", FLAG_LATE_PAYMENTS_SQL, (["WGR-000000"],)),
+    ("pending reminders page", PENDING_REMINDERS_SQL, ("", REMINDER_PAGE_SIZE)),
+    ("ipn backlog", IPN_BACKLOG_SQL, (IPN_BATCH_SIZE, IPN_LEASE_SECONDS)),
+    ("stats leaderboard", stats_board.query, (STATS_BOARD_SIZE,)),
+    ("role leaderboard", role_board.query, (ROLE_BOARD_SIZE,)),
+    ("profile", PROFILE_SQL, (0,)),
+    ("sweeper stale wagers", STALE_WAGERS_SQL, (timedelta(hours=1), SWEEP_BATCH_SIZE)),
+    ("sweeper expiry", EXPIRE_WAGERS_SQL, (["WGR-000000"],)),
+    ("sweeper archive", ARCHIVE_WAGERS_SQL, (timedelta(days=1), SWEEP_BATCH_SIZE)),
+    ("ledger compaction", COMPACT_LEDGER_SQL, (LEDGER_COMPACT_BATCH,)),
+]
+
+def _seq_scans(plan: dict) -> list:
+    found = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for child in plan.get("Plans", ()):
+        found += _seq_scans(child)
+    return found
+
+async def check_query_plans() -> list:
+    # With seq scans priced out, any Seq Scan left in a plan means no index
+    # can serve that query, whatever the current table sizes.
+    flagged = []
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            for name, sql, args in CHECKED_QUERIES:
+                plan = json.loads(await conn.fetchval("EXPLAIN (FORMAT JSON) " + sql, *args))
+                tables = _seq_scans(plan[0]["Plan"])
+                if tables:
+                    flagged.append(name)
+                    print(f"⚠️ Query '{name}' falls back to a seq scan on {', '.join(tables)}")
+    return flagged
+
 # ---------- Run ----------
 async def start_webserver():
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    site = web.TCPSite(runner, '0.0.0.0', WEB_PORT)
     await site.start()
 
-async def main():
+async def open_database():
     global db_pool
-    db_pool = await asyncpg.create_pool(**DB_CONFIG)
-    asyncio.create_task(start_webserver())
-    periodic_reminders.start()
-    await bot.start(TOKEN)
+    check_db_budget()
+    db_pool = InstrumentedPool(await asyncpg.create_pool(
+        **DB_CONFIG, min_size=min(10, DB_POOL_SIZE), max_size=DB_POOL_SIZE,
+    ))
+    await migrate()
+    # Warm the caches the first commands read before letting them through
+    await asyncio.gather(check_query_plans(), load_rank_cache(), role_board.top(), stats_board.top())
+    db_ready.set()
+    print(f"🗄️ Database ready after {time.monotonic() - STARTED_AT:.1f}s")
+
+async def start_jobs():
+    await db_ready.wait()
+    await coordinator.step()
+    spawn(coordinator.run())
+    if BOT_ROLE in ("all", "ipn"):
+        spawn(ipn_worker())
+    sweep_wagers.start()
+    if coordinator.campaign:
+        # Leader-gated loops: every process that can win the election runs all of them
+        compact_ledger.start()
+        periodic_reminders.start()
+
+async def main():
+    global http_session
+    http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    # Pool, webserver and gateway come up concurrently; DB users wait on db_ready.
+    startup = [open_database(), start_webserver(), start_jobs()]
+    if BOT_ROLE != "ipn":
+        startup.append(bot.start(TOKEN))
+    await asyncio.gather(*startup)
+    if BOT_ROLE == "ipn":
+        await asyncio.Event().wait()
 
 if __name__ == '__main__':
     asyncio.run(main())